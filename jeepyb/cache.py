@@ -0,0 +1,88 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Per-project state shared by manage-projects and track-upstream.
+
+The state of each project is a small dict stored as JSON in its own row of
+an SQLite database, so it can be saved as soon as a project is done and
+read one project at a time.  The database runs in WAL mode, readers do
+not block the writer and vice versa.
+
+A project.cache JSON file from older versions is imported the first time
+the database is created.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+log = logging.getLogger("jeepyb.cache")
+
+
+class ProjectCache(object):
+
+    def __init__(self, cache_dir):
+        self.db_file = os.path.join(cache_dir, 'project.cache.db')
+        self.json_file = os.path.join(cache_dir, 'project.cache')
+        self._lock = threading.Lock()
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.conn = sqlite3.connect(self.db_file, timeout=60,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS projects ("
+                              "name TEXT PRIMARY KEY, state TEXT NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS migrations ("
+                              "name TEXT PRIMARY KEY)")
+        self._migrate_json()
+
+    def _migrate_json(self):
+        with self._lock, self.conn:
+            done = self.conn.execute(
+                "SELECT 1 FROM migrations WHERE name = 'json'").fetchone()
+            if done:
+                return
+            if os.path.exists(self.json_file):
+                log.info("Importing %s into %s", self.json_file, self.db_file)
+                with open(self.json_file, 'r') as cache_in:
+                    states = json.loads(cache_in.read())
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO projects (name, state) "
+                    "VALUES (?, ?)",
+                    [(name, json.dumps(state, sort_keys=True))
+                     for name, state in states.items()])
+            self.conn.execute("INSERT INTO migrations (name) VALUES ('json')")
+
+    def get(self, project):
+        """Return a copy of the state of project, {} if there is none."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT state FROM projects WHERE name = ?",
+                (project,)).fetchone()
+        if row is None:
+            return {}
+        return json.loads(row[0])
+
+    def set(self, project, state):
+        """Store the state of project and commit it straight away."""
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO projects (name, state) "
+                "VALUES (?, ?)", (project, json.dumps(state, sort_keys=True)))
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -38,10 +38,10 @@ DEFAULT_ORG = os.environ.get('DEFAULT_ORG', None)
 
 
 def main():
-    registry = u.ProjectsRegistry(PROJECTS_YAML)
     gitorgs = {}
     names = set()
-    for entry in registry.configs_list:
+    for entry in u.iter_projects(PROJECTS_YAML,
+                                 keys=('project', 'description')):
         project = entry['project']
         if '/' in project:
             (org, name) = project.split('/')
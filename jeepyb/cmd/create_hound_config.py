@@ -29,8 +29,8 @@ GIT_PROTOCOL = os.environ.get('GIT_PROTOCOL', 'git://')
 
 
 def main():
-    registry = u.ProjectsRegistry(PROJECTS_YAML)
-    projects = [entry['project'] for entry in registry.configs_list]
+    projects = [entry['project'] for entry in
+                u.iter_projects(PROJECTS_YAML, keys=('project',))]
     repos = {}
     for project in projects:
         repos[os.path.basename(project)] = {
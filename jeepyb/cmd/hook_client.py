@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# hook_client.py is what the Gerrit hook scripts call instead of the hook
+# commands themselves.  It passes the hook's arguments on to hook-server
+# and returns as soon as the event is queued.  If the server is not
+# running, the hook is run here the way its own command would run it.
+#
+#   hook-client update-bug patchset-created --change ... --project ...
+
+import argparse
+import os
+import sys
+
+import jeepyb.hooks
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Hand a Gerrit hook event to the hook server.')
+    parser.add_argument('--socket', default=jeepyb.hooks.DEFAULT_SOCKET,
+                        help='hook server socket (default: %(default)s)')
+    parser.add_argument('--wait', action='store_true',
+                        help='wait until the hook has been processed')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds to wait for the server to queue the '
+                             'event (default: %(default)s)')
+    parser.add_argument('hook', choices=sorted(jeepyb.hooks.HOOKS))
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='arguments for the hook')
+    args = parser.parse_args()
+
+    request = dict(hook=args.hook, argv=args.args,
+                   git_dir=os.environ.get('GIT_DIR'), wait=args.wait)
+    try:
+        reply = jeepyb.hooks.send_request(
+            args.socket, request, None if args.wait else args.timeout)
+    except jeepyb.hooks.ServerUnavailable as e:
+        sys.stderr.write("hook server unavailable (%s), running %s here\n"
+                         % (e, args.hook))
+        jeepyb.hooks.run_in_process(args.hook, args.args)
+        return
+
+    if reply.get('error'):
+        sys.stderr.write("%s: %s\n" % (args.hook, reply['error']))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#! /usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# hook_server.py runs the Gerrit hooks (update-bug, update-blueprint,
+# notify-impact, welcome-message and trivial-rebase) in one long running
+# process, so launchpadlib, the Launchpad logins, projects.yaml and the
+# database connections stay loaded between events.  The Gerrit hook
+# scripts hand their arguments over with hook-client:
+#
+#   hook-client update-bug patchset-created --change ... --project ...
+#
+# Events for the same change are processed in the order they arrive;
+# events for different changes run concurrently on --workers threads.
+# Paths given to the hooks (like notify-impact's --config) are opened by
+# the server, so they have to be absolute.
+
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import SocketServer
+import sys
+
+import jeepyb.dispatch
+import jeepyb.gerritdb
+import jeepyb.hooks
+import jeepyb.log as l
+
+log = logging.getLogger("hook_server")
+
+
+class HookRequestHandler(SocketServer.StreamRequestHandler):
+
+    def reply(self, **reply):
+        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line.decode('utf-8'))
+            log.debug("Received %s %s" % (request.get('hook'),
+                                          request.get('argv')))
+            job = jeepyb.hooks.dispatch(
+                self.server.dispatcher, self.server.modules,
+                request.get('hook'), request.get('argv') or [],
+                git_dir=request.get('git_dir'))
+        except (ValueError, jeepyb.hooks.HookError) as e:
+            log.error("Rejected request: %s" % e)
+            self.reply(status='rejected', error=str(e))
+            return
+
+        if not request.get('wait'):
+            self.reply(status='queued')
+            return
+        job.wait()
+        if job.error:
+            self.reply(status='done', error=job.error)
+        else:
+            self.reply(status='done')
+
+
+class HookServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, dispatcher):
+        self.dispatcher = dispatcher
+        self.modules = jeepyb.hooks.load_hooks()
+
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except socket.error:
+                # Left behind by a server that is gone
+                os.unlink(socket_path)
+            else:
+                raise RuntimeError("A hook server is already listening on %s"
+                                   % socket_path)
+            finally:
+                probe.close()
+
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               HookRequestHandler)
+        os.chmod(socket_path, 0o600)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run the Gerrit hooks in a long running process.')
+    parser.add_argument('--socket', default=jeepyb.hooks.DEFAULT_SOCKET,
+                        help='Unix socket to listen on (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of events processed concurrently')
+    l.setup_logging_arguments(parser)
+    args = parser.parse_args()
+    l.configure_logging(args)
+
+    jeepyb.gerritdb.configure(size=args.workers)
+    dispatcher = jeepyb.dispatch.Dispatcher(args.workers, name='hook')
+    server = HookServer(args.socket, dispatcher)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log.info("Listening on %s with %d workers" % (args.socket, args.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+        log.info("Finishing %d queued events" % dispatcher.backlog())
+        dispatcher.stop()
+        jeepyb.gerritdb.get_pool().close()
+
+
+if __name__ == "__main__":
+    main()
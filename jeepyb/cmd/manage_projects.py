@@ -24,6 +24,7 @@
 # gerrit-key=/home/gerrit2/review_site/etc/ssh_host_rsa_key
 # gerrit-committer=Project Creator <openstack-infra@lists.openstack.org>
 # gerrit-replicate=True
+# ssh-multiplex=True
 # has-github=True
 # has-wiki=False
 # has-issues=False
@@ -44,6 +45,8 @@
 #   description: This is a great project
 #   upstream: https://gerrit.googlesource.com/gerrit
 #   upstream-prefix: upstream
+#   upstream-import: partial
+#   upstream-mirror: /path/to/a/local/mirror/of/upstream.git
 #   acl-config: /path/to/gerrit/project.config
 #   acl-append:
 #     - /path/to/gerrit/project.config
@@ -52,26 +55,32 @@
 
 import argparse
 import ConfigParser
-import glob
+from email import utils as email_utils
 import hashlib
 import json
 import logging
+import multiprocessing.pool
 import os
 import re
 import shutil
+import tempfile
+import threading
 import time
 
 import gerritlib.gerrit
 import github
 
+import jeepyb.cache
 import jeepyb.gerritdb
+import jeepyb.gitrepo as gitrepo
 import jeepyb.log as l
+import jeepyb.queries
+import jeepyb.upstream
 import jeepyb.utils as u
 
-registry = u.ProjectsRegistry()
-
 log = logging.getLogger("manage_projects")
-orgs = None
+# Seconds spent waiting for each project's refs/meta/config in this run.
+config_wait_times = {}
 
 # Gerrit system groups as defined:
 # https://review.openstack.org/Documentation/access-control.html#system_groups
@@ -84,6 +93,10 @@ GERRIT_SYSTEM_GROUPS = {
 }
 
 
+# Where fetch_config puts a copy of the project's refs/meta/config.
+META_CONFIG = "remotes/gerrit-meta/config"
+
+
 class FetchConfigException(Exception):
     pass
 
@@ -96,249 +109,513 @@ class CreateGroupException(Exception):
     pass
 
 
-def fetch_config(project, remote_url, repo_path, env=None):
+class ConfigReadyEvents(object):
+    """Per-project events set when Gerrit reports refs/meta/config changes.
+
+    fetch_config waits on these in between polls, so an event from Gerrit
+    (or anything else calling notify()) ends the wait straight away instead
+    of after the current backoff.
+    """
+
+    def __init__(self):
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def event_for(self, project):
+        with self._lock:
+            return self._events.setdefault(project, threading.Event())
+
+    def notify(self, project):
+        self.event_for(project).set()
+
+    def handle_event(self, event):
+        if event.get('type') == 'project-created':
+            self.notify(event.get('projectName'))
+        elif event.get('type') == 'ref-updated':
+            ref_update = event.get('refUpdate', {})
+            if ref_update.get('refName') == 'refs/meta/config':
+                self.notify(ref_update.get('project'))
+
+    def watch(self, gerrit):
+        """Feed events from Gerrit's stream-events in a background thread."""
+        def _consume():
+            while True:
+                try:
+                    self.handle_event(gerrit.getEvent())
+                except Exception:
+                    log.exception("Failed to handle Gerrit event")
+
+        gerrit.startWatching()
+        thread = threading.Thread(target=_consume)
+        thread.daemon = True
+        thread.start()
+
+
+def fetch_config(project, remote_url, repo, repo_path, env=None,
+                 timeout=60, event=None):
     env = env or {}
-    # Poll for refs/meta/config as gerrit may not have written it out for
+    start = time.time()
+    # Wait for refs/meta/config as gerrit may not have written it out for
     # us yet.
-    for x in range(10):
-        status = u.git_command(
-            repo_path,
-            "fetch %s +refs/meta/config:refs/remotes/gerrit-meta/config"
-            % remote_url, env)
-        if status == 0:
-            break
-        else:
-            log.debug("Failed to fetch refs/meta/config for project: %s" %
-                      project)
-            time.sleep(2)
-    if status != 0:
+    if u.wait_for_ref(remote_url, "refs/meta/config", env, timeout,
+                      event) is None:
         log.error("Failed to fetch refs/meta/config for project: %s" % project)
         raise FetchConfigException()
 
-    # Poll for project.config as gerrit may not have committed an empty
-    # one yet.
-    output = ""
-    for x in range(10):
-        status = u.git_command(repo_path, "remote update --prune", env)
+    # Fetch it until it has a project.config, as gerrit may not have
+    # committed an empty one yet.
+    found = False
+    remaining = max(timeout - (time.time() - start), 0)
+    for _ in u.backoff(remaining, event=event):
+        status = u.git_command(
+            repo_path,
+            "fetch %s +refs/meta/config:refs/%s" % (remote_url, META_CONFIG),
+            env)
         if status != 0:
-            log.error("Failed to update remote: %s" % remote_url)
-            time.sleep(2)
-            continue
-        else:
-            status, output = u.git_command_output(
-                repo_path, "ls-files --with-tree=remotes/gerrit-meta/config "
-                "project.config", env)
-        if output.strip() != "project.config" or status != 0:
-            log.debug("Failed to find project.config for project: %s" %
+            log.debug("Failed to fetch refs/meta/config for project: %s" %
                       project)
-            time.sleep(2)
-        else:
+            continue
+        found = repo.rev_parse("%s:project.config" % META_CONFIG)
+        if found:
             break
-    if output.strip() != "project.config" or status != 0:
+        log.debug("Failed to find project.config for project: %s" %
+                  project)
+    if not found:
         log.error("Failed to find project.config for project: %s" % project)
         raise FetchConfigException()
 
-    # Because the following fails if executed more than once you should only
-    # run fetch_config once in each repo.
-    status = u.git_command(
-        repo_path, "checkout -B config remotes/gerrit-meta/config")
-    if status != 0:
-        log.error("Failed to checkout config for project: %s" % project)
-        raise FetchConfigException()
+    config_wait_times[project] = time.time() - start
+    log.info("Waited %.2fs for refs/meta/config of project: %s" %
+             (config_wait_times[project], project))
 
 
-def copy_acl_config(project, repo_path, acl_config):
+def copy_acl_config(project, repo, repo_path, acl_config):
+    """Write acl_config to the object database.
+
+    Returns the blob id of the new project.config, or None if it is the
+    same as the one in refs/meta/config already.
+    """
     if not os.path.exists(acl_config):
         raise CopyACLException()
 
-    acl_dest = os.path.join(repo_path, "project.config")
-    status, _ = u.run_command(
-        "cp %s %s" % (acl_config, acl_dest), status=True)
+    status, blob = u.git_command_output(
+        repo_path, "hash-object -w %s" % acl_config)
     if status != 0:
         raise CopyACLException()
 
-    status = u.git_command(repo_path, "diff --quiet")
-    return status != 0
+    if repo.rev_parse("%s:project.config" % META_CONFIG) == blob:
+        return None
+    return blob
 
 
-def push_acl_config(project, remote_url, repo_path, gitid, env=None):
-    env = env or {}
-    cmd = "commit -a -m'Update project config.' --author='%s'" % gitid
-    status = u.git_command(repo_path, cmd)
+def commit_acl_config(project, repo, repo_path, files, gitid):
+    """Commit files on top of refs/meta/config without a checkout.
+
+    files maps file names to blob ids. The new tree is built in a
+    temporary index, so neither the work tree nor HEAD are touched.
+    Returns the new commit id, or None if the tree would not change.
+    """
+    index_env = dict(GIT_INDEX_FILE=os.path.join(
+        repo_path, '.git', 'jeepyb-acl-index'))
+    parent_tree = repo.rev_parse("%s^{tree}" % META_CONFIG)
+    try:
+        status = u.git_command(
+            repo_path, "read-tree %s" % META_CONFIG, index_env)
+        for name, blob in sorted(files.items()):
+            if status == 0:
+                status = u.git_command(
+                    repo_path, "update-index --add --cacheinfo 100644 %s %s"
+                    % (blob, name), index_env)
+        if status == 0:
+            status, tree = u.git_command_output(
+                repo_path, "write-tree", index_env)
+    finally:
+        if os.path.exists(index_env['GIT_INDEX_FILE']):
+            os.unlink(index_env['GIT_INDEX_FILE'])
+    if status != 0:
+        log.error("Failed to build config tree for project: %s" % project)
+        raise CopyACLException()
+
+    if tree == parent_tree:
+        return None
+
+    author_env = {}
+    if gitid:
+        name, email = email_utils.parseaddr(gitid)
+        author_env = dict(GIT_AUTHOR_NAME=name, GIT_AUTHOR_EMAIL=email)
+    status, commit = u.git_command_output(
+        repo_path, "commit-tree %s -p %s -m'Update project config.'"
+        % (tree, META_CONFIG), author_env)
     if status != 0:
         log.error("Failed to commit config for project: %s" % project)
-        return False
+        raise CopyACLException()
+    return commit
+
+
+def push_acl_config(project, remote_url, repo_path, commit, env=None):
+    env = env or {}
     status, out = u.git_command_output(
-        repo_path, "push %s HEAD:refs/meta/config" % remote_url, env)
+        repo_path, "push %s %s:refs/meta/config" % (remote_url, commit), env)
     if status != 0:
         log.error("Failed to push config for project: %s" % project)
         return False
     return True
 
 
-def _get_group_uuid(group, retries=10):
+class ThreadLocalGerrit(threading.local):
+    """A gerritlib Gerrit client with its own ssh connection per thread.
+
+    gerritlib keeps a single ssh connection per Gerrit object and closes
+    it whenever a command fails, which would break the commands other
+    worker threads are running over it.  Attribute lookups go to the
+    calling thread's Gerrit object, which is created on first use.
     """
+
+    def __init__(self, *args):
+        self.gerrit = gerritlib.gerrit.Gerrit(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.gerrit, name)
+
+
+class GroupUUIDResolver(object):
+    """Resolve Gerrit group names to UUIDs for the duration of a run.
+
     Gerrit keeps internal user groups in the DB while it keeps systems
-    groups in All-Projects groups file (in refs/meta/config).  This
-    will only get the UUIDs for internal user groups.
+    groups in All-Projects groups file (in refs/meta/config).  All internal
+    groups are loaded with a single query the first time a name is
+    resolved and are then kept in memory, so the same groups showing up in
+    many project.config files cost nothing after the first one.
 
     Note: 'Administrators', 'Non-Interactive Users' and all other custom
     groups in Gerrit are defined as internal user groups.
-
-    Wait for up to 10 seconds for the group to be created in the DB.
     """
-    query = "SELECT group_uuid FROM account_groups WHERE name = %s"
-    con = jeepyb.gerritdb.connect()
-    for x in range(retries):
-        cursor = con.cursor()
-        cursor.execute(query, (group,))
-        data = cursor.fetchone()
-        cursor.close()
-        con.commit()
-        if data:
-            return data[0]
-        if retries > 1:
-            time.sleep(1)
-    return None
 
+    def __init__(self, gerrit, timeout=10):
+        self.gerrit = gerrit
+        self.timeout = timeout
+        self.uuids = None
+        self.created = set()
+        self._lock = threading.Lock()
+
+    def _query(self, groups):
+        uuids = jeepyb.queries.group_uuids(groups)
+        with self._lock:
+            self.uuids.update(uuids)
+            return [group for group in groups if group not in self.uuids]
+
+    def _create(self, groups):
+        # Groups may have been created since the first query, by another
+        # worker or outside of this run, so ask again before creating.
+        # Each group is claimed under the lock and then created without
+        # it, so it is only created once even if another worker still
+        # cannot see it, and the other workers are not held up by the
+        # ssh round trips.
+        missing = self._query(groups)
+        with self._lock:
+            claimed = [group for group in missing
+                       if group not in self.created]
+            self.created.update(claimed)
+        for i, group in enumerate(claimed):
+            log.info("Creating group %s in Gerrit" % group)
+            try:
+                self.gerrit.createGroup(group)
+            except Exception:
+                # Let a later caller try the ones not created again
+                with self._lock:
+                    self.created.difference_update(claimed[i:])
+                raise
+
+        # Wait for up to timeout seconds for the groups to show up in the
+        # DB, checking for all of them at once and without holding the
+        # lock, so the other workers are not held up.
+        deadline = time.time() + self.timeout
+        while missing and time.time() < deadline:
+            time.sleep(1)
+            missing = self._query(missing)
+
+    def resolve(self, groups):
+        """Return a dict mapping each of groups to its UUID.
+
+        Groups that Gerrit does not know about yet are created first.
+        Raises CreateGroupException if some of them never show up.
+        """
+        missing = [group for group in groups
+                   if group not in GERRIT_SYSTEM_GROUPS]
+        with self._lock:
+            if self.uuids is None:
+                self.uuids = jeepyb.queries.group_uuids()
+            missing = [group for group in missing if group not in self.uuids]
+        if missing:
+            self._create(missing)
+
+        uuids = {}
+        with self._lock:
+            for group in groups:
+                uuid = self.uuids.get(group, GERRIT_SYSTEM_GROUPS.get(group))
+                if not uuid:
+                    log.error("Unable to get UUID for group %s." % group)
+                    raise CreateGroupException()
+                uuids[group] = uuid
+        return uuids
 
-def get_group_uuid(gerrit, group):
-    uuid = _get_group_uuid(group, retries=1)
-    if uuid:
-        return uuid
-    if group in GERRIT_SYSTEM_GROUPS:
-        return GERRIT_SYSTEM_GROUPS[group]
-    gerrit.createGroup(group)
-    uuid = _get_group_uuid(group)
-    if uuid:
-        return uuid
-    return None
 
+def create_groups_file(project, group_resolver, repo_path, acl_config):
+    """Write the groups file for acl_config to the object database.
 
-def create_groups_file(project, gerrit, repo_path):
-    acl_config = os.path.join(repo_path, "project.config")
-    group_file = os.path.join(repo_path, "groups")
-    uuids = {}
+    Returns its blob id, or None if acl_config does not name any groups.
+    """
+    groups = set()
     for line in open(acl_config, 'r'):
         r = re.match(r'^.*\sgroup\s+(.*)$', line)
         if r:
-            group = r.group(1)
-            if group in uuids.keys():
-                continue
-            uuid = get_group_uuid(gerrit, group)
-            if uuid:
-                uuids[group] = uuid
-            else:
-                log.error("Unable to get UUID for group %s." % group)
-                raise CreateGroupException()
-    if uuids:
-        with open(group_file, 'w') as fp:
-            for group, uuid in uuids.items():
+            groups.add(r.group(1))
+    uuids = group_resolver.resolve(groups)
+    if not uuids:
+        return None
+
+    (fd, group_file) = tempfile.mkstemp(dir=os.path.join(repo_path, '.git'))
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            # Sorted like Gerrit writes it, so an unchanged ACL gives
+            # the same tree and no new refs/meta/config commit
+            for group, uuid in sorted(uuids.items(), key=lambda kv: kv[1]):
                 fp.write("%s\t%s\n" % (uuid, group))
-        status = u.git_command(repo_path, "add groups")
-        if status != 0:
-            log.error("Failed to add groups file for project: %s" % project)
-            raise CreateGroupException()
+        status, blob = u.git_command_output(
+            repo_path, "hash-object -w %s" % group_file)
+    finally:
+        os.unlink(group_file)
+    if status != 0:
+        log.error("Failed to add groups file for project: %s" % project)
+        raise CreateGroupException()
+    return blob
+
+
+class GithubSync(object):
+    """Bring GitHub repositories in line with projects.yaml in bulk.
+
+    Projects are queued with add() while they are processed. sync() then
+    lists the repositories and teams of every org involved once, works
+    out locally which repositories have to be created, edited or added to
+    the gerrit team, and only issues those calls, from up to workers
+    threads at a time. Orgs with so few queued projects that listing all
+    of their repositories would take more calls than looking each project
+    up have their projects looked up one by one instead. When fewer than
+    reserve API calls are left in the current rate limit window, calls
+    wait for the window to reset.
+    """
+
+    # Results per page of the list calls, the most github allows
+    PER_PAGE = 100
+    # Calls to look up a project: its repository and the gerrit team's
+    LOOKUP_CALLS = 2
+
+    def __init__(self, secure_config_file, workers=1, reserve=100):
+        self.secure_config_file = secure_config_file
+        self.workers = workers
+        self.reserve = reserve
+        self.requests = []
+        self.projects = set()
+        self._lock = threading.Lock()
+        self._throttle_lock = threading.Lock()
+        self.ghub = None
+
+    def pending(self, project):
+        with self._lock:
+            return project in self.projects
+
+    def add(self, project, has_issues, has_downloads, has_wiki,
+            description, homepage, cache):
+        with self._lock:
+            self.requests.append(dict(
+                project=project, has_issues=has_issues,
+                has_downloads=has_downloads, has_wiki=has_wiki,
+                description=description, homepage=homepage, cache=cache))
+            self.projects.add(project)
+
+    def _connect(self):
+        secure_config = ConfigParser.ConfigParser()
+        secure_config.read(self.secure_config_file)
+        if secure_config.has_option("github", "oauth_token"):
+            return github.Github(secure_config.get("github", "oauth_token"),
+                                 per_page=self.PER_PAGE)
+        return github.Github(secure_config.get("github", "username"),
+                             secure_config.get("github", "password"),
+                             per_page=self.PER_PAGE)
+
+    def _throttle(self):
+        with self._throttle_lock:
+            remaining, limit = self.ghub.rate_limiting
+            if remaining < self.reserve:
+                delay = max(self.ghub.rate_limiting_resettime - time.time(),
+                            0)
+                log.info("Only %d github API calls left, waiting %ds for "
+                         "the rate limit to reset", remaining, delay)
+                time.sleep(delay)
+
+    def _prefetch(self, pending):
+        """Fetch what is needed about the orgs in pending.
+
+        pending maps org names to their number of queued projects.  The
+        repos and team_repos of orgs whose projects are looked up one by
+        one are None.
+        """
+        log.info('Fetching github org list')
+        orgs = {}
+        for org in self.ghub.get_user().get_orgs():
+            count = pending.get(org.login.lower())
+            if not count:
+                continue
+            log.info("Fetching github teams of %s", org.login)
+            teams = dict((t.name.lower(), t) for t in org.get_teams())
+            repos = None
+            team_repos = None
+            # Listing takes a call per page of repositories, for the org
+            # and again for the gerrit team
+            size = org.public_repos + (org.total_private_repos or 0)
+            pages = 2 * ((size + self.PER_PAGE - 1) // self.PER_PAGE)
+            if pages <= self.LOOKUP_CALLS * count:
+                log.info("Fetching github repos of %s", org.login)
+                repos = dict((r.name.lower(), r) for r in org.get_repos())
+                team_repos = set()
+                if 'gerrit' in teams:
+                    team_repos = set(
+                        r.name.lower() for r in teams['gerrit'].get_repos())
+            orgs[org.login.lower()] = dict(
+                org=org, repos=repos, teams=teams, team_repos=team_repos)
+        return orgs
+
+    def _find_repo(self, org_info, repo_name):
+        if org_info['repos'] is not None:
+            return org_info['repos'].get(repo_name.lower())
+        self._throttle()
+        try:
+            return org_info['org'].get_repo(repo_name)
+        except github.UnknownObjectException:
+            return None
+
+    def _in_team(self, org_info, repo_name, repo):
+        if org_info['team_repos'] is not None:
+            return repo_name.lower() in org_info['team_repos']
+        self._throttle()
+        return org_info['teams']['gerrit'].has_in_repos(repo)
+
+    def _sync_project(self, request, org_info):
+        project = request['project']
+        cache = request['cache']
+        created = False
+        repo_name = project.split('/', 1)[-1]
+        has_issues = request['has_issues']
+        has_downloads = request['has_downloads']
+        has_wiki = request['has_wiki']
+        description = request['description']
+        homepage = request['homepage']
+
+        repo = self._find_repo(org_info, repo_name)
+        if repo is None:
+            log.info("Creating %s in github", repo_name)
+            self._throttle()
+            repo = org_info['org'].create_repo(repo_name,
+                                               homepage=homepage,
+                                               has_issues=has_issues,
+                                               has_downloads=has_downloads,
+                                               has_wiki=has_wiki)
+            created = True
+
+        cache['created-in-github'] = True
+        cache['has_wiki'] = has_wiki
+        cache['has_downloads'] = has_downloads
+        cache['has_issues'] = has_issues
+
+        kwargs = {}
+        # If necessary, update project on Github
+        if description and description != repo.description:
+            kwargs['description'] = description
+        if homepage and homepage != repo.homepage:
+            kwargs['homepage'] = homepage
+        if has_issues != repo.has_issues:
+            kwargs['has_issues'] = has_issues
+        if has_downloads != repo.has_downloads:
+            kwargs['has_downloads'] = has_downloads
+        if has_wiki != repo.has_wiki:
+            kwargs['has_wiki'] = has_wiki
+
+        if kwargs:
+            log.info("Updating github repo info about %s", repo_name)
+            self._throttle()
+            repo.edit(repo_name, **kwargs)
+        cache.update(kwargs)
+
+        if not cache.get('gerrit-in-team', False):
+            if created or not self._in_team(org_info, repo_name, repo):
+                log.info("Adding gerrit to github team for %s", repo_name)
+                self._throttle()
+                org_info['teams']['gerrit'].add_to_repos(repo)
+            cache['gerrit-in-team'] = True
+            created = True
+
+        return created
+
+    def sync(self):
+        """Apply all queued requests.
+
+        Returns the set of projects that were created or newly added to
+        the gerrit team, and the set of projects that failed.
+        """
+        created = set()
+        failed = set()
+        if not self.requests:
+            return created, failed
+
+        pending = {}
+        for request in self.requests:
+            org_name = request['project'].split('/', 1)[0].lower()
+            pending[org_name] = pending.get(org_name, 0) + 1
+        try:
+            self.ghub = self._connect()
+            orgs = self._prefetch(pending)
+        except Exception:
+            log.exception("Problems fetching github org information")
+            failed.update(r['project'] for r in self.requests)
+            return created, failed
+
+        def _sync(request):
+            project = request['project']
+            org_info = orgs.get(project.split('/', 1)[0].lower())
+            if org_info is None:
+                # We do not have control of this github org ignore the
+                # project.
+                return
+            try:
+                if self._sync_project(request, org_info):
+                    created.add(project)
+            except Exception:
+                log.exception("Problems syncing %s to github" % project)
+                failed.add(project)
 
+        pool = multiprocessing.pool.ThreadPool(self.workers)
+        try:
+            pool.map(_sync, self.requests)
+        finally:
+            pool.close()
+            pool.join()
+        return created, failed
 
-def create_update_github_project(
-        default_has_issues, default_has_downloads, default_has_wiki,
-        github_secure_config, options, project, description, homepage,
-        cache):
-    created = False
-    has_issues = 'has-issues' in options or default_has_issues
-    has_downloads = 'has-downloads' in options or default_has_downloads
-    has_wiki = 'has-wiki' in options or default_has_wiki
 
-    needs_update = False
+def github_needs_update(cache, has_issues, has_downloads, has_wiki,
+                        default_has_issues, default_has_downloads,
+                        default_has_wiki):
     if not cache.get('created-in-github', False):
-        needs_update = True
+        return True
     if not cache.get('gerrit-in-team', False):
-        needs_update = True
+        return True
     if cache.get('has_issues', default_has_issues) != has_issues:
-        needs_update = True
+        return True
     if cache.get('has_downloads', default_has_downloads) != has_downloads:
-        needs_update = True
+        return True
     if cache.get('has_wiki', default_has_wiki) != has_wiki:
-        needs_update = True
-    if not needs_update:
-        return False
-
-    secure_config = ConfigParser.ConfigParser()
-    secure_config.read(github_secure_config)
-
-    global orgs
-    if orgs is None:
-        if secure_config.has_option("github", "oauth_token"):
-            ghub = github.Github(secure_config.get("github", "oauth_token"))
-        else:
-            ghub = github.Github(secure_config.get("github", "username"),
-                                 secure_config.get("github", "password"))
-
-        log.info('Fetching github org list')
-        orgs = ghub.get_user().get_orgs()
-    orgs_dict = dict(zip([o.login.lower() for o in orgs], orgs))
-
-    # Find the project's repo
-    project_split = project.split('/', 1)
-    org_name = project_split[0]
-    if len(project_split) > 1:
-        repo_name = project_split[1]
-    else:
-        repo_name = project
-
-    try:
-        org = orgs_dict[org_name.lower()]
-    except KeyError:
-        # We do not have control of this github org ignore the project.
-        return False
-
-    try:
-        log.info("Fetching github info about %s", repo_name)
-        repo = org.get_repo(repo_name)
-
-    except github.GithubException:
-        log.info("Creating %s in github", repo_name)
-        repo = org.create_repo(repo_name,
-                               homepage=homepage,
-                               has_issues=has_issues,
-                               has_downloads=has_downloads,
-                               has_wiki=has_wiki)
-        created = True
-
-    cache['created-in-github'] = True
-    cache['has_wiki'] = has_wiki
-    cache['has_downloads'] = has_downloads
-    cache['has_issues'] = has_issues
-
-    kwargs = {}
-    # If necessary, update project on Github
-    if description and description != repo.description:
-        kwargs['description'] = description
-    if homepage and homepage != repo.homepage:
-        kwargs['homepage'] = homepage
-    if has_issues != repo.has_issues:
-        kwargs['has_issues'] = has_issues
-    if has_downloads != repo.has_downloads:
-        kwargs['has_downloads'] = has_downloads
-    if has_wiki != repo.has_wiki:
-        kwargs['has_wiki'] = has_wiki
-
-    if kwargs:
-        log.info("Updating github repo info about %s", repo_name)
-        repo.edit(repo_name, **kwargs)
-    cache.update(kwargs)
-
-    if not cache.get('gerrit-in-team', False):
-        if 'gerrit' not in [team.name for team in repo.get_teams()]:
-            log.info("Adding gerrit to github team for %s", repo_name)
-            teams = org.get_teams()
-            teams_dict = dict(zip([t.name.lower() for t in teams], teams))
-            teams_dict['gerrit'].add_to_repos(repo)
-        cache['gerrit-in-team'] = True
-        created = True
-
-    return created
+        return True
+    return False
 
 
 # TODO(mordred): Inspect repo_dir:master for a description
@@ -347,16 +624,6 @@ def find_description_override(repo_path):
     return None
 
 
-def fsck_repo(repo_path):
-    rc, out = u.git_command_output(repo_path, 'fsck --full')
-    # Check for non zero return code or warnings which should
-    # be treated as errors. In this case zeroPaddedFilemodes
-    # will not be accepted by Gerrit/jgit but are accepted by C git.
-    if rc != 0 or 'zeroPaddedFilemode' in out:
-        log.error('git fsck of %s failed:\n%s' % (repo_path, out))
-        raise Exception('git fsck failed not importing')
-
-
 def push_to_gerrit(repo_path, project, push_string, remote_url, ssh_env):
     try:
         u.git_command(repo_path, push_string % remote_url, env=ssh_env)
@@ -364,63 +631,45 @@ def push_to_gerrit(repo_path, project, push_string, remote_url, ssh_env):
     except Exception:
         log.exception(
             "Error pushing %s to Gerrit." % project)
-
-
-def sync_upstream(repo_path, project, ssh_env, upstream_prefix):
-    u.git_command(
-        repo_path,
-        "remote update upstream --prune", env=ssh_env)
-    # Any branch that exists in the upstream remote, we want
-    # a local branch of, optionally prefixed with the
-    # upstream prefix value
-    for branch in u.git_command_output(
-            repo_path, "branch -a")[1].split('\n'):
-        if not branch.strip().startswith("remotes/upstream"):
-            continue
-        if "->" in branch:
-            continue
-        local_branch = branch.split()[0][len('remotes/upstream/'):]
-        if upstream_prefix:
-            local_branch = "%s/%s" % (
-                upstream_prefix, local_branch)
-
-        # Check out an up to date copy of the branch, so that
-        # we can push it and it will get picked up below
-        u.git_command(repo_path, "checkout -B %s %s" % (
-            local_branch, branch))
-
-    try:
-        # Push all of the local branches to similarly named
-        # Branches on gerrit. Also, push all of the tags
-        u.git_command(
-            repo_path,
-            "push origin refs/heads/*:refs/heads/*",
-            env=ssh_env)
-        u.git_command(repo_path, 'push origin --tags', env=ssh_env)
-    except Exception:
-        log.exception(
-            "Error pushing %s to Gerrit." % project)
+    # Only count the project as imported once Gerrit has all of it
+    jeepyb.upstream.verify_push(
+        remote_url,
+        jeepyb.upstream.pushed_refs(repo_path, push_string.split()[-1]),
+        ssh_env)
 
 
 def process_acls(acl_config, project, ACL_DIR, section,
-                 remote_url, repo_path, ssh_env, gerrit, GERRIT_GITID):
+                 remote_url, repo_path, ssh_env, group_resolver,
+                 GERRIT_GITID, config_timeout=60, config_event=None):
     if not os.path.isfile(acl_config):
         return
+    if not os.path.exists(repo_path):
+        # Only refs/meta/config is needed, an empty repository will do
+        u.run_command("git init %s" % repo_path)
+    repo = gitrepo.GitRepo(repo_path)
     try:
-        fetch_config(project, remote_url, repo_path, ssh_env)
-        if not copy_acl_config(project, repo_path, acl_config):
+        fetch_config(project, remote_url, repo, repo_path, ssh_env,
+                     config_timeout, config_event)
+        config_blob = copy_acl_config(project, repo, repo_path, acl_config)
+        if not config_blob:
             # nothing was copied, so we're done
             return
-        create_groups_file(project, gerrit, repo_path)
-        push_acl_config(project, remote_url, repo_path,
-                        GERRIT_GITID, ssh_env)
+        files = {'project.config': config_blob}
+        groups_blob = create_groups_file(
+            project, group_resolver, repo_path, acl_config)
+        if groups_blob:
+            files['groups'] = groups_blob
+        commit = commit_acl_config(
+            project, repo, repo_path, files, GERRIT_GITID)
+        if not commit:
+            log.info("Config of %s is unchanged, not pushing" % project)
+            return
+        push_acl_config(project, remote_url, repo_path, commit, ssh_env)
     except Exception:
         log.exception(
             "Exception processing ACLS for %s." % project)
     finally:
-        u.git_command(repo_path, 'reset --hard')
-        u.git_command(repo_path, 'checkout master')
-        u.git_command(repo_path, 'branch -D config')
+        repo.close()
 
 
 def create_gerrit_project(project, project_list, gerrit):
@@ -450,21 +699,116 @@ def create_local_mirror(local_git_dir, project_git,
                 gerrit_system_user, gerrit_system_group, git_mirror_path))
 
 
+class ACLDigestCache(object):
+    """SHA-256 digests of ACL files, kept across runs in cache_file.
+
+    Files are only hashed when they are first asked for, and a stored
+    digest is reused for as long as the size, mtime and inode of the file
+    are unchanged.
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.digests = {}
+        self.dirty = False
+        self._lock = threading.Lock()
+        if os.path.exists(cache_file):
+            try:
+                self.digests = json.loads(open(cache_file, 'r').read())
+            except ValueError:
+                log.warning("Ignoring corrupt ACL cache %s" % cache_file)
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime, st.st_ino]
+
+    def get(self, path):
+        key = self._stat(path)
+        if key is None:
+            return None
+        with self._lock:
+            entry = self.digests.get(path)
+        if entry and entry['stat'] == key:
+            return entry['sha256']
+
+        sha256 = hashlib.sha256()
+        with open(path, 'r') as acl_file:
+            sha256.update(acl_file.read())
+        if self._stat(path) != key:
+            # Changed while it was read, the digest may not match the
+            # file under either stat so it is not kept
+            return sha256.hexdigest()
+        with self._lock:
+            self.digests[path] = dict(stat=key, sha256=sha256.hexdigest())
+            self.dirty = True
+        return sha256.hexdigest()
+
+    def save(self):
+        with self._lock:
+            if not self.dirty:
+                return
+            tmp_file = '%s.tmp' % self.cache_file
+            with open(tmp_file, 'w') as cache_out:
+                cache_out.write(json.dumps(
+                    self.digests, sort_keys=True, indent=2))
+            os.rename(tmp_file, self.cache_file)
+            self.dirty = False
+
+
+def get_acl_config(section, acl_dir):
+    return section.get(
+        'acl-config',
+        '%s.config' % os.path.join(acl_dir, section['project']))
+
+
+def project_fingerprint(section, acl_sha, defaults):
+    """Hash everything that decides what processing a project will do.
+
+    When the fingerprint stored in the project's cache entry matches, the
+    project has already been brought in line with this exact projects.yaml
+    section, ACL file and set of defaults, and can be skipped outright.
+    """
+    sha256 = hashlib.sha256()
+    sha256.update(json.dumps(
+        [section, acl_sha, defaults], sort_keys=True, default=str))
+    return sha256.hexdigest()
+
+
 def main():
     parser = argparse.ArgumentParser(description='Manage projects')
     l.setup_logging_arguments(parser)
     parser.add_argument('--nocleanup', action='store_true',
                         help='do not remove temp directories')
+    parser.add_argument('--force', action='store_true',
+                        help='process projects even if their configuration '
+                             'is unchanged since the last run')
+    parser.add_argument('--config-timeout', type=int, default=60,
+                        help='seconds to wait for Gerrit to create '
+                             'refs/meta/config of a project')
+    parser.add_argument('--stream-events', action='store_true',
+                        help='use Gerrit stream-events to learn when '
+                             'refs/meta/config is ready')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of projects to process in parallel')
     parser.add_argument('projects', metavar='project', nargs='*',
                         help='name of project(s) to process')
     args = parser.parse_args()
     l.configure_logging(args)
 
+    registry = u.ProjectsRegistry()
+    # One database connection per worker thread at most
+    jeepyb.gerritdb.configure(size=max(args.workers, 1))
+
     default_has_github = registry.get_defaults('has-github', True)
 
     LOCAL_GIT_DIR = registry.get_defaults('local-git-dir', '/var/lib/git')
     JEEPYB_CACHE_DIR = registry.get_defaults('jeepyb-cache-dir',
                                              '/var/lib/jeepyb')
+    OBJECT_CACHE_DIR = os.path.join(JEEPYB_CACHE_DIR, 'objects')
     ACL_DIR = registry.get_defaults('acl-dir')
     GERRIT_HOST = registry.get_defaults('gerrit-host')
     GITREVIEW_GERRIT_HOST = registry.get_defaults(
@@ -475,6 +819,8 @@ def main():
     GERRIT_USER = registry.get_defaults('gerrit-user')
     GERRIT_KEY = registry.get_defaults('gerrit-key')
     GERRIT_GITID = registry.get_defaults('gerrit-committer')
+    SSH_MULTIPLEX = registry.get_defaults('ssh-multiplex', True)
+    SSH_CONTROL_DIR = os.path.join(JEEPYB_CACHE_DIR, 'ssh')
     GERRIT_REPLICATE = registry.get_defaults('gerrit-replicate', True)
     GERRIT_OS_SYSTEM_USER = registry.get_defaults('gerrit-system-user',
                                                   'gerrit2')
@@ -487,136 +833,241 @@ def main():
     GITHUB_SECURE_CONFIG = registry.get_defaults(
         'github-config',
         '/etc/github/github-projects.secure.config')
-    PROJECT_CACHE_FILE = os.path.join(JEEPYB_CACHE_DIR, 'project.cache')
-    project_cache = {}
-    if os.path.exists(PROJECT_CACHE_FILE):
-        project_cache = json.loads(open(PROJECT_CACHE_FILE, 'r').read())
-    acl_cache = {}
-    for acl_file in glob.glob(os.path.join(ACL_DIR, '*/*.config')):
-        sha256 = hashlib.sha256()
-        sha256.update(open(acl_file, 'r').read())
-        acl_cache[acl_file] = sha256.hexdigest()
+    project_cache = jeepyb.cache.ProjectCache(JEEPYB_CACHE_DIR)
+    acl_cache = ACLDigestCache(os.path.join(JEEPYB_CACHE_DIR, 'acl.cache'))
+
+    # Any default that changes how a project is set up has to invalidate
+    # the fingerprints of every project.
+    fingerprint_defaults = [
+        default_has_github, LOCAL_GIT_DIR, ACL_DIR, GERRIT_HOST,
+        GERRIT_PORT, GITREVIEW_GERRIT_HOST, GITREVIEW_GERRIT_PORT,
+        DEFAULT_HOMEPAGE, DEFAULT_HAS_ISSUES, DEFAULT_HAS_DOWNLOADS,
+        DEFAULT_HAS_WIKI]
+
+    log_buffer = l.ProjectLogBuffer()
+    work = []
+    skipped = 0
+    for section in registry.configs_list:
+        project = section['project']
+        if args.projects and project not in args.projects:
+            continue
+        cache = project_cache.get(project)
+        fingerprint = project_fingerprint(
+            section, acl_cache.get(get_acl_config(section, ACL_DIR)),
+            fingerprint_defaults)
+        if not args.force and cache.get('fingerprint') == fingerprint:
+            skipped += 1
+            continue
+        work.append((section, cache, fingerprint))
+    acl_cache.save()
+    log.info("Processing %d projects, %d unchanged since the last run",
+             len(work), skipped)
+    if not work:
+        project_cache.close()
+        return
 
-    gerrit = gerritlib.gerrit.Gerrit(GERRIT_HOST,
-                                     GERRIT_USER,
-                                     GERRIT_PORT,
-                                     GERRIT_KEY)
+    gerrit_args = (GERRIT_HOST, GERRIT_USER, GERRIT_PORT, GERRIT_KEY)
+    gerrit = ThreadLocalGerrit(*gerrit_args)
     project_list = gerrit.listProjects()
-    ssh_env = u.make_ssh_wrapper(GERRIT_USER, GERRIT_KEY)
-    try:
-        for section in registry.configs_list:
-            project = section['project']
-            if args.projects and project not in args.projects:
-                continue
+    group_resolver = GroupUUIDResolver(gerrit)
+    config_events = ConfigReadyEvents()
+    github_sync = GithubSync(GITHUB_SECURE_CONFIG, max(args.workers, 1))
+    if args.stream_events:
+        # Events are read from another thread, so the watcher needs a
+        # Gerrit object of its own rather than a per-thread one
+        config_events.watch(gerritlib.gerrit.Gerrit(*gerrit_args))
+    ssh_env = u.make_ssh_wrapper(
+        GERRIT_USER, GERRIT_KEY,
+        control_dir=SSH_CONTROL_DIR if SSH_MULTIPLEX else None)
+
+    def process_project(section, cache):
+        project = section['project']
+        repo_path = os.path.join(JEEPYB_CACHE_DIR, project)
+        try:
+            log.info("Processing project: %s" % project)
+
+            # Figure out all of the options
+            options = section.get('options', dict())
+            description = section.get('description', None)
+            homepage = section.get('homepage', DEFAULT_HOMEPAGE)
+            upstream = section.get('upstream', None)
+
+            # If this project doesn't want to use gerrit, exit cleanly.
+            if 'no-gerrit' in options:
+                return True
+
+            project_git = "%s.git" % project
+            remote_url = "ssh://%s:%s/%s" % (
+                GERRIT_HOST,
+                GERRIT_PORT,
+                project)
+            git_opts = dict(upstream=upstream,
+                            repo_path=repo_path,
+                            remote_url=remote_url)
+            acl_config = get_acl_config(section, ACL_DIR)
+
+            # Create the project in Gerrit first, since it will fail
+            # spectacularly if its project directory or local replica
+            # already exist on disk
+            project_created = cache.get('project-created', False)
+            if not project_created:
+                try:
+                    project_created = create_gerrit_project(
+                        project, project_list, gerrit)
+                    cache['project-created'] = True
+                except Exception:
+                    cache['project-created'] = False
+                    return False
+
+            pushed_to_gerrit = cache.get('pushed-to-gerrit', False)
+            if not pushed_to_gerrit:
+                # We haven't pushed to gerrit, so grab the repo again
+                if os.path.exists(repo_path):
+                    shutil.rmtree(repo_path)
 
-            try:
-                log.info("Processing project: %s" % project)
-
-                # Figure out all of the options
-                options = section.get('options', dict())
-                description = section.get('description', None)
-                homepage = section.get('homepage', DEFAULT_HOMEPAGE)
-                upstream = section.get('upstream', None)
-                repo_path = os.path.join(JEEPYB_CACHE_DIR, project)
-
-                # If this project doesn't want to use gerrit, exit cleanly.
-                if 'no-gerrit' in options:
-                    continue
-
-                project_git = "%s.git" % project
-                remote_url = "ssh://%s:%s/%s" % (
-                    GERRIT_HOST,
-                    GERRIT_PORT,
-                    project)
-                git_opts = dict(upstream=upstream,
-                                repo_path=repo_path,
-                                remote_url=remote_url)
-                acl_config = section.get(
-                    'acl-config',
-                    '%s.config' % os.path.join(ACL_DIR, project))
-                project_cache.setdefault(project, {})
-
-                # Create the project in Gerrit first, since it will fail
-                # spectacularly if its project directory or local replica
-                # already exist on disk
-                project_created = project_cache[project].get(
-                    'project-created', False)
-                if not project_created:
-                    try:
-                        project_created = create_gerrit_project(
-                            project, project_list, gerrit)
-                        project_cache[project]['project-created'] = True
-                    except Exception:
-                        project_cache[project]['project-created'] = False
-                        continue
-
-                pushed_to_gerrit = project_cache[project].get(
-                    'pushed-to-gerrit', False)
-                if not pushed_to_gerrit:
-                    # We haven't pushed to gerrit, so grab the repo again
-                    if os.path.exists(repo_path):
-                        shutil.rmtree(repo_path)
-
-                    # Make Local repo
-                    push_string = u.make_local_copy(
-                        repo_path, project, project_list,
-                        git_opts, ssh_env, upstream, GITREVIEW_GERRIT_HOST,
-                        GITREVIEW_GERRIT_PORT, project_git, GERRIT_GITID)
-
-                    description = (
-                        find_description_override(repo_path)
-                        or description)
-
-                    fsck_repo(repo_path)
-
-                    if push_string:
-                        push_to_gerrit(
-                            repo_path, project, push_string,
-                            remote_url, ssh_env)
-                    project_cache[project]['pushed-to-gerrit'] = True
-                    if GERRIT_REPLICATE:
-                        gerrit.replicate(project)
-
-                # Create the repo for the local git mirror
-                create_local_mirror(
-                    LOCAL_GIT_DIR, project_git,
-                    GERRIT_OS_SYSTEM_USER, GERRIT_OS_SYSTEM_GROUP)
-
-                if acl_config:
-                    acl_sha = acl_cache.get(acl_config)
-                    if project_cache[project].get('acl-sha') != acl_sha:
-                        process_acls(
-                            acl_config, project, ACL_DIR, section,
-                            remote_url, repo_path, ssh_env, gerrit,
-                            GERRIT_GITID)
-                        project_cache[project]['acl-sha'] = acl_sha
-                    else:
-                        log.info("%s has matching sha, skipping ACLs",
-                                 project)
-
-                if 'has-github' in options or default_has_github:
-                    created = create_update_github_project(
+                import_mode, reference = jeepyb.upstream.import_mode(
+                    section)
+                if import_mode != 'mirror':
+                    # Everything is pushed to Gerrit, so a partial
+                    # clone would only have to fetch the rest later.
+                    # Refresh the object cache for this project, kept
+                    # across runs, the clone below borrows its objects
+                    # and only has to fetch what it lacks
+                    cache_path = os.path.join(OBJECT_CACHE_DIR,
+                                              project_git)
+                    if project in project_list:
+                        reference = u.update_object_cache(
+                            cache_path, 'gerrit', remote_url, ssh_env)
+                    if upstream:
+                        reference = u.update_object_cache(
+                            cache_path, 'upstream', upstream,
+                            ssh_env) or reference
+
+                # Make Local repo
+                start = time.time()
+                push_string = u.make_local_copy(
+                    repo_path, project, project_list,
+                    git_opts, ssh_env, upstream, GITREVIEW_GERRIT_HOST,
+                    GITREVIEW_GERRIT_PORT, project_git, GERRIT_GITID,
+                    reference=reference)
+                log.info("Imported %s (%s) in %.1fs: %s" %
+                         (project, import_mode, time.time() - start,
+                          u.describe_objects(repo_path)))
+
+                description = (
+                    find_description_override(repo_path)
+                    or description)
+
+                u.fsck_repo(repo_path)
+
+                if push_string:
+                    push_to_gerrit(
+                        repo_path, project, push_string,
+                        remote_url, ssh_env)
+                cache['pushed-to-gerrit'] = True
+                if GERRIT_REPLICATE:
+                    gerrit.replicate(project)
+
+            # Create the repo for the local git mirror
+            create_local_mirror(
+                LOCAL_GIT_DIR, project_git,
+                GERRIT_OS_SYSTEM_USER, GERRIT_OS_SYSTEM_GROUP)
+
+            if acl_config:
+                acl_sha = acl_cache.get(acl_config)
+                if cache.get('acl-sha') != acl_sha:
+                    process_acls(
+                        acl_config, project, ACL_DIR, section,
+                        remote_url, repo_path, ssh_env, group_resolver,
+                        GERRIT_GITID, args.config_timeout,
+                        config_events.event_for(project))
+                    cache['acl-sha'] = acl_sha
+                else:
+                    log.info("%s has matching sha, skipping ACLs",
+                             project)
+
+            if 'has-github' in options or default_has_github:
+                has_issues = 'has-issues' in options or DEFAULT_HAS_ISSUES
+                has_downloads = DEFAULT_HAS_DOWNLOADS
+                if 'has-downloads' in options:
+                    has_downloads = True
+                has_wiki = 'has-wiki' in options or DEFAULT_HAS_WIKI
+                if github_needs_update(
+                        cache, has_issues, has_downloads, has_wiki,
                         DEFAULT_HAS_ISSUES, DEFAULT_HAS_DOWNLOADS,
-                        DEFAULT_HAS_WIKI, GITHUB_SECURE_CONFIG,
-                        options, project, description, homepage,
-                        project_cache[project])
-                    if created and GERRIT_REPLICATE:
-                        gerrit.replicate(project)
+                        DEFAULT_HAS_WIKI):
+                    # The github side is handled in bulk after all
+                    # projects are processed, see GithubSync.
+                    github_sync.add(project, has_issues, has_downloads,
+                                    has_wiki, description, homepage, cache)
 
-            except Exception:
-                log.exception(
-                    "Problems creating %s, moving on." % project)
-                continue
-            finally:
-                # Clean up after ourselves - this repo has no use
-                if os.path.exists(repo_path):
-                    shutil.rmtree(repo_path)
+            return True
+        except Exception:
+            log.exception(
+                "Problems creating %s, moving on." % project)
+            return False
+        finally:
+            # Clean up after ourselves - this repo has no use
+            if os.path.exists(repo_path):
+                shutil.rmtree(repo_path)
+
+    def run_worker(item):
+        # Each worker gets its own copy of the project's cache entry, which
+        # is saved to project_cache by the main thread.
+        section, cache, fingerprint = item
+        log_buffer.start(section['project'])
+        try:
+            if process_project(section, cache):
+                cache['fingerprint'] = fingerprint
+            else:
+                cache.pop('fingerprint', None)
+        finally:
+            records = log_buffer.stop()
+        return section['project'], cache, records
+
+    pool = None
+    try:
+        if args.workers > 1:
+            log_buffer.install()
+            pool = multiprocessing.pool.ThreadPool(args.workers)
+            results = pool.imap_unordered(run_worker, work)
+        else:
+            results = (run_worker(w) for w in work)
+        # Each project is recorded as soon as it is done, whatever the
+        # projects before it are still doing.  Its log is held back by
+        # log_buffer until then, so it is written out in one piece.
+        for project, cache, records in results:
+            log_buffer.flush(records)
+            if github_sync.pending(project):
+                # Only keep the fingerprint once GitHub is in sync too.
+                cache = dict(cache)
+                cache.pop('fingerprint', None)
+            project_cache.set(project, cache)
+
+        created, failed = github_sync.sync()
+        for request in github_sync.requests:
+            if request['project'] in failed:
+                # Make sure the next run tries again.
+                request['cache'].pop('fingerprint', None)
+            project_cache.set(request['project'], request['cache'])
+        if GERRIT_REPLICATE:
+            for project in created:
+                gerrit.replicate(project)
+
+        if config_wait_times:
+            slowest = max(config_wait_times, key=config_wait_times.get)
+            log.info("Waited for refs/meta/config of %d projects, %.2fs in "
+                     "total, longest %.2fs for %s",
+                     len(config_wait_times),
+                     sum(config_wait_times.values()),
+                     config_wait_times[slowest], slowest)
     finally:
-        with open(PROJECT_CACHE_FILE, 'w') as cache_out:
-            log.info("Writing cache file %s", PROJECT_CACHE_FILE)
-            cache_out.write(json.dumps(
-                project_cache, sort_keys=True, indent=2))
-        os.unlink(ssh_env['GIT_SSH'])
+        if pool:
+            pool.terminate()
+            pool.join()
+        log_buffer.uninstall()
+        project_cache.close()
+        u.cleanup_ssh_wrapper(ssh_env)
 
 if __name__ == "__main__":
     main()
@@ -38,11 +38,9 @@ import smtplib
 import subprocess
 
 from email.mime import text
-from launchpadlib import launchpad
-from launchpadlib import uris
-import yaml
 
 from jeepyb import projects
+from jeepyb import utils
 
 
 logger = logging.getLogger('notify_impact')
@@ -136,12 +134,7 @@ def create_bug(git_log, args, config):
                    % args.project)
         lp_project = project_name
 
-    lpconn = launchpad.Launchpad.login_with(
-        'Gerrit User Sync',
-        uris.LPNET_SERVICE_ROOT,
-        GERRIT_CACHE_DIR,
-        credentials_file=GERRIT_CREDENTIALS,
-        version='devel')
+    lpconn = utils.launchpad_login(GERRIT_CACHE_DIR, GERRIT_CREDENTIALS)
 
     if args.dryrun:
         actions = BugActionsDryRun(lpconn)
@@ -246,7 +239,7 @@ def extract_git_log(args):
     return subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
 
 
-def main():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('hook')
 
@@ -303,8 +296,10 @@ def main():
     parser.add_argument('--smtp-pass', dest='smtp_pass',
                         default=os.getenv('SMTP_PASS'))
 
-    args = parser.parse_args()
+    return parser.parse_args(argv)
+
 
+def process(args):
     # NOTE(mikal): the basic idea here is to let people watch
     # docimpact bugs filed by people of interest. For example
     # my team's tech writer wants to be subscribed to all the
@@ -323,7 +318,12 @@ def main():
     # list of launchpad user ids.
     config = {}
     if args.config:
-        config = yaml.load(args.config.read())
+        # yaml is slow to import, so only pay for it when needed
+        import yaml
+        try:
+            config = yaml.load(args.config.read(), Loader=utils.yaml_loader())
+        finally:
+            args.config.close()
 
     # Get git log
     git_log = extract_git_log(args)
@@ -332,5 +332,9 @@ def main():
     if impacted(git_log, args.impact):
         process_impact(git_log, args, config)
 
+
+def main():
+    process(parse_args())
+
 if __name__ == "__main__":
     main()
@@ -19,7 +19,6 @@ import logging
 import os
 
 import jeepyb.log as l
-import jeepyb.projects as p
 import jeepyb.translations as t
 import jeepyb.utils as u
 
@@ -37,13 +36,12 @@ def main():
     args = parser.parse_args()
     l.configure_logging(args)
 
-    registry = u.ProjectsRegistry(PROJECTS_YAML)
     rest_service = t.ZanataRestService(ZANATA_URL, ZANATA_USER, ZANATA_KEY)
     log.info("Registering projects in Zanata")
-    for entry in registry.configs_list:
-        project = entry['project']
-        if not p.has_translations(project):
+    for entry in u.iter_projects(PROJECTS_YAML, keys=('project', 'options')):
+        if 'translate' not in (entry.get('options') or []):
             continue
+        project = entry['project']
         log.info("Processing project %s" % project)
         (org, name) = project.split('/')
         try:
@@ -0,0 +1,379 @@
+#! /usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# stream_events.py (jeepyb-events) runs the Gerrit hooks from Gerrit's
+# stream-events feed instead of from hook scripts.  It keeps one ssh
+# connection running "gerrit stream-events" and turns every
+# patchset-created, change-merged and change-abandoned event into the
+# arguments Gerrit would have passed to the hook scripts.  With
+# --events-file it reads recorded events (one JSON object per line)
+# instead and exits at the end of the file.
+#
+# Which hooks run for which events is set in a yaml file given with
+# --config, along with any extra arguments the hooks need:
+#
+#   update-bug:
+#     events: [patchset-created, change-merged, change-abandoned]
+#   welcome-message:
+#     events: [patchset-created]
+#     args: [--ssh-user, welcome, --ssh-key, /home/gerrit2/.ssh/welcome]
+#
+# Without it update-bug and update-blueprint run for all three events.
+#
+# Events are processed by --workers threads, in order for each change.
+# Each worker queues at most --queue-size hook runs; when a queue is full
+# the feed is not read until there is room again.  Events are kept in a
+# spool in --state-dir until they have been processed, so those that
+# were still queued when the consumer stopped are processed after it
+# restarts.  That only covers events that were received: Gerrit does not
+# replay stream-events, so the hooks do not run for events that happen
+# while the consumer is stopped or reconnecting.
+
+import argparse
+import collections
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+
+import yaml
+
+import jeepyb.dispatch
+import jeepyb.gerritdb
+import jeepyb.hooks
+import jeepyb.log as l
+import jeepyb.utils as u
+
+log = logging.getLogger("stream_events")
+
+EVENTS = ('patchset-created', 'change-merged', 'change-abandoned')
+DEFAULT_HOOKS = {
+    'update-bug': dict(events=list(EVENTS)),
+    'update-blueprint': dict(events=list(EVENTS)),
+}
+
+
+def account(data):
+    """Format an account the way Gerrit passes it to hooks."""
+    if not data:
+        return None
+    return '%s (%s)' % (data.get('name', ''), data.get('email', ''))
+
+
+def event_argv(event):
+    """Return the hook arguments Gerrit would have used for event."""
+    change = event.get('change') or {}
+    patchset = event.get('patchSet') or {}
+    options = [('change', change.get('id')),
+               ('change-url', change.get('url')),
+               ('project', change.get('project')),
+               ('branch', change.get('branch')),
+               ('topic', change.get('topic')),
+               ('change-owner', account(change.get('owner'))),
+               ('commit', patchset.get('revision'))]
+    if event['type'] == 'patchset-created':
+        uploader = event.get('uploader') or patchset.get('uploader')
+        options += [('uploader', account(uploader)),
+                    ('patchset', patchset.get('number')),
+                    ('is-draft', str(patchset.get('isDraft', False)).lower()),
+                    ('kind', patchset.get('kind'))]
+    elif event['type'] == 'change-merged':
+        options += [('submitter', account(event.get('submitter'))),
+                    ('newrev', event.get('newRev'))]
+    elif event['type'] == 'change-abandoned':
+        options += [('abandoner', account(event.get('abandoner'))),
+                    ('reason', event.get('reason', ''))]
+
+    argv = [event['type']]
+    for option, value in options:
+        if value is not None:
+            argv.append('--%s=%s' % (option, value))
+    return argv
+
+
+def load_config(config_file):
+    """Return a dict of event type to a list of (hook, extra args)."""
+    hook_config = DEFAULT_HOOKS
+    if config_file:
+        with open(config_file, 'r') as config_in:
+            hook_config = yaml.load(config_in, Loader=u.yaml_loader())
+
+    event_hooks = {}
+    for hook, settings in sorted(hook_config.items()):
+        settings = settings or {}
+        if hook not in jeepyb.hooks.HOOKS:
+            raise ValueError("Unknown hook %s in %s" % (hook, config_file))
+        for event_type in settings.get('events', EVENTS):
+            if event_type not in EVENTS:
+                raise ValueError("Unsupported event %s for %s in %s" %
+                                 (event_type, hook, config_file))
+            event_hooks.setdefault(event_type, []).append(
+                (hook, [str(arg) for arg in settings.get('args', [])]))
+    return event_hooks
+
+
+class EventJournal(object):
+    """Events received but not processed yet, kept across restarts.
+
+    No event that made it into the spool is lost, but events Gerrit sent
+    while nothing was reading the feed never get here.
+
+    Every event is appended to a spool file before it is dispatched.  The
+    checkpoint file records the spool offset up to which all events have
+    been processed, and the creation time of the last of them, so that
+    replaying a recorded events file skips what was processed before.
+    The spool is emptied whenever everything in it has been processed.
+    """
+
+    def __init__(self, state_dir):
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+        self.spool_path = os.path.join(state_dir, 'events.spool')
+        self.checkpoint_path = os.path.join(state_dir, 'events.checkpoint')
+        self.lock = threading.Lock()
+        self.offset = 0
+        self.created_on = 0
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'r') as checkpoint:
+                state = json.loads(checkpoint.read())
+            self.offset = state['offset']
+            self.created_on = state['created_on']
+        self.spool = open(self.spool_path, 'a+')
+        self._drop_partial_line()
+
+    def _size(self):
+        self.spool.seek(0, os.SEEK_END)
+        return self.spool.tell()
+
+    def _drop_partial_line(self):
+        # A crash halfway through an append leaves a partial last line
+        if not self._size():
+            return
+        self.spool.seek(0)
+        content = self.spool.read()
+        if not content.endswith('\n'):
+            log.warning("Dropping the incomplete last event in %s" %
+                        self.spool_path)
+            self.spool.truncate(content.rfind('\n') + 1)
+
+    def pending(self):
+        """Yield (offset, line) for the events after the checkpoint.
+
+        offset is where the event ends in the spool.
+        """
+        with open(self.spool_path, 'r') as spool:
+            spool.seek(self.offset)
+            for line in iter(spool.readline, ''):
+                yield spool.tell(), line.rstrip('\n')
+
+    def append(self, line):
+        """Add an event to the spool, return the offset it ends at."""
+        with self.lock:
+            self.spool.write(line + '\n')
+            self.spool.flush()
+            return self._size()
+
+    def processed(self, offset, created_on):
+        """Record that all events up to offset have been processed."""
+        with self.lock:
+            self.offset = offset
+            self.created_on = max(self.created_on, created_on)
+            if offset == self._size():
+                self.spool.seek(0)
+                self.spool.truncate()
+                self.offset = 0
+            tmp_path = '%s.tmp' % self.checkpoint_path
+            with open(tmp_path, 'w') as checkpoint:
+                checkpoint.write(json.dumps(dict(offset=self.offset,
+                                                 created_on=self.created_on)))
+            os.rename(tmp_path, self.checkpoint_path)
+
+    def close(self):
+        self.spool.close()
+
+
+class InFlight(object):
+    """Events being processed, in the order they were received."""
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.events = collections.deque()
+        self.lock = threading.Lock()
+
+    def add(self, offset, created_on, jobs):
+        with self.lock:
+            self.events.append((offset, created_on, jobs))
+
+    def advance(self):
+        """Move the checkpoint past the events processed so far.
+
+        The checkpoint only moves past an event once it and every event
+        received before it are done.
+        """
+        last = None
+        with self.lock:
+            while self.events and all(job.done for job in self.events[0][2]):
+                last = self.events.popleft()
+        if last:
+            self.journal.processed(last[0], last[1])
+
+
+def stream_ssh(host, port, user, key, stop):
+    """Yield stream-events lines, reconnecting whenever ssh exits.
+
+    Events from while the connection was down are not sent again.
+    """
+    cmd = ("ssh -o BatchMode=yes -o ServerAliveInterval=60 -p %s -i %s "
+           "-l %s %s gerrit stream-events %s" %
+           (port, key, user, host,
+            ' '.join('-s %s' % event_type for event_type in EVENTS)))
+    delay = 1
+    while not stop.is_set():
+        command = u.Command(cmd)
+        try:
+            for line in command:
+                delay = 1
+                yield line
+        finally:
+            command.cancel()
+        log.warning("stream-events exited with %s, reconnecting in %ss" %
+                    (command.wait(), delay))
+        stop.wait(delay)
+        delay = min(delay * 2, 60)
+
+
+def stream_file(events_file):
+    with open(events_file, 'r') as events:
+        for line in events:
+            yield line.rstrip('\n')
+
+
+def parse_event(line):
+    """Return the event on line if it is one jeepyb-events handles."""
+    try:
+        event = json.loads(line)
+    except ValueError:
+        log.warning("Ignoring a line that is not an event: %s" % line)
+        return None
+    if not isinstance(event, dict) or event.get('type') not in EVENTS:
+        return None
+    return event
+
+
+def dispatch_event(dispatcher, modules, event_hooks, event):
+    jobs = []
+    argv = event_argv(event)
+    for hook, extra_args in event_hooks.get(event['type'], []):
+        try:
+            jobs.append(jeepyb.hooks.dispatch(dispatcher, modules, hook,
+                                              argv + extra_args))
+        except jeepyb.hooks.HookError as e:
+            log.error("Could not run %s for %s: %s" %
+                      (hook, event['type'], e))
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run the Gerrit hooks from the stream-events feed.')
+    parser.add_argument('--config', default=None,
+                        help='yaml file mapping hooks to events')
+    parser.add_argument('--events-file', default=None,
+                        help='read recorded events from this file instead '
+                             'of from Gerrit')
+    parser.add_argument('--state-dir', default='/var/lib/jeepyb/events',
+                        help='where the spool and checkpoint are kept '
+                             '(default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of events processed concurrently')
+    parser.add_argument('--queue-size', type=int, default=100,
+                        help='hook runs each worker can have queued '
+                             'before the feed is paused')
+    l.setup_logging_arguments(parser)
+    args = parser.parse_args()
+    l.configure_logging(args)
+
+    event_hooks = load_config(args.config)
+    modules = jeepyb.hooks.load_hooks(
+        set(hook for hooks in event_hooks.values() for hook, _ in hooks))
+
+    journal = EventJournal(args.state_dir)
+    in_flight = InFlight(journal)
+    jeepyb.gerritdb.configure(size=args.workers)
+    dispatcher = jeepyb.dispatch.Dispatcher(
+        args.workers, queue_size=args.queue_size, name='event')
+    stop = threading.Event()
+
+    def checkpointer():
+        while not stop.wait(1):
+            in_flight.advance()
+
+    checkpoint_thread = threading.Thread(target=checkpointer)
+    checkpoint_thread.daemon = True
+    checkpoint_thread.start()
+
+    if args.events_file:
+        source = stream_file(args.events_file)
+    else:
+        registry = u.ProjectsRegistry()
+        source = stream_ssh(registry.get_defaults('gerrit-host'),
+                            registry.get_defaults('gerrit-port', '29418'),
+                            registry.get_defaults('gerrit-user'),
+                            registry.get_defaults('gerrit-key'),
+                            stop)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        # Events left over from the last run go first
+        replayed = 0
+        for offset, line in journal.pending():
+            event = parse_event(line)
+            if event:
+                in_flight.add(offset, event.get('eventCreatedOn', 0),
+                              dispatch_event(dispatcher, modules,
+                                             event_hooks, event))
+                replayed += 1
+        if replayed:
+            log.info("Replayed %d events from the spool" % replayed)
+
+        for line in source:
+            event = parse_event(line)
+            if not event:
+                continue
+            created_on = event.get('eventCreatedOn', 0)
+            # Only a recorded file holds events an earlier run has seen.
+            # The live feed never sends old ones, but it can send events
+            # slightly out of order, which must not be skipped.
+            if args.events_file and created_on < journal.created_on:
+                log.debug("Skipping %s from before the checkpoint" %
+                          event['type'])
+                continue
+            offset = journal.append(line)
+            in_flight.add(offset, created_on,
+                          dispatch_event(dispatcher, modules, event_hooks,
+                                         event))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        log.info("Finishing %d queued events" % dispatcher.backlog())
+        dispatcher.stop()
+        in_flight.advance()
+        journal.close()
+        jeepyb.gerritdb.get_pool().close()
+
+
+if __name__ == "__main__":
+    main()
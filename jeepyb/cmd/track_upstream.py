@@ -24,12 +24,14 @@
 # gerrit-key=/home/gerrit2/review_site/etc/ssh_host_rsa_key
 # gerrit-committer=Project Creator <openstack-infra@lists.openstack.org>
 # gerrit-replicate=True
+# ssh-multiplex=True
 # has-github=True
 # has-wiki=False
 # has-issues=False
 # has-downloads=False
 # acl-dir=/home/gerrit2/acls
 # acl-base=/home/gerrit2/acls/project.config
+# full-fsck-days=7
 #
 # manage_projects.py reads a project listing file called projects.yaml
 # It should look like:
@@ -44,35 +46,118 @@
 #   description: This is a great project
 #   upstream: https://gerrit.googlesource.com/gerrit
 #   upstream-prefix: upstream
+#   upstream-import: partial
+#   upstream-mirror: /path/to/a/local/mirror/of/upstream.git
 #   acl-config: /path/to/gerrit/project.config
 #   acl-append:
 #     - /path/to/gerrit/project.config
 #   acl-parameters:
 #     project: OTHER_PROJECT_NAME
+#
+# Projects are fetched from their upstreams by --workers threads, with at
+# most --per-host-limit fetches from any one upstream host at a time.  As
+# soon as a project has been fetched it is checked and pushed to Gerrit by
+# one of --local-workers threads, while the other projects are fetched.
+# Projects whose upstream branches and tags are all in Gerrit already are
+# not fetched at all.
+#
+# The local copies in jeepyb-cache-dir/import are bare repositories, with
+# Gerrit's branches under refs/remotes/origin and upstream's under
+# refs/remotes/upstream; copies with a working tree left by older
+# versions are converted on their next run.  Every maintenance-days
+# (projects.ini, default 1) each copy gets a commit-graph and a
+# multi-pack-index written and its stale refs/copy/* refs removed, and
+# git gc --auto runs after every sync.
+#
+# A project's upstream-import setting says how its local copy is made:
+# "partial" leaves out the blobs of the history Gerrit already has, and
+# "mirror" copies the objects it can from upstream-mirror.  Partial only
+# helps here; manage-projects pushes all of a new project to Gerrit, so
+# its first import is always complete.
 
 import argparse
-import json
+import collections
 import logging
+import multiprocessing.pool
 import os
-
-import gerritlib.gerrit
-
+import re
+import shutil
+import threading
+import time
+import urlparse
+
+import jeepyb.cache
+import jeepyb.gitrepo as gitrepo
 import jeepyb.log as l
+import jeepyb.upstream
 import jeepyb.utils as u
 
-registry = u.ProjectsRegistry()
-
 log = logging.getLogger("track_upstream")
 orgs = None
 
 
-def update_local_copy(repo_path, track_upstream, git_opts, ssh_env):
-    # first do a clean of the branch to prevent possible
-    # problems due to previous runs
-    u.git_command(repo_path, "clean -fdx")
+def prune_refs(repo_path, prefix):
+    with gitrepo.GitRepo(repo_path) as repo:
+        refs = repo.refs(prefix)
+    if refs:
+        # One update-ref for all of them rather than one per ref
+        u.git_command(repo_path, "update-ref --stdin",
+                      input=''.join("delete %s\n" % ref
+                                    for ref in sorted(refs)))
+    return len(refs)
+
+
+def needs_conversion(repo_path):
+    if os.path.isdir(os.path.join(repo_path, '.git')):
+        return True
+    return os.path.isdir('%s.bare' % repo_path)
+
+
+def convert_to_bare(repo_path):
+    """Turn a local copy with a working tree into a bare repository."""
+    log.info("Converting %s to a bare repository" % repo_path)
+    # Each step can be redone if an earlier run stopped halfway
+    bare_path = '%s.bare' % repo_path
+    git_dir = os.path.join(repo_path, '.git')
+    if os.path.isdir(git_dir):
+        os.rename(git_dir, bare_path)
+    if os.path.isdir(repo_path):
+        shutil.rmtree(repo_path)
+    os.rename(bare_path, repo_path)
+    index = os.path.join(repo_path, 'index')
+    if os.path.exists(index):
+        os.unlink(index)
+    u.git_command(repo_path, "config core.bare true")
+
+
+def make_local_copy(repo_path, git_opts, ssh_env, reference=None,
+                    partial=False):
+    """Clone Gerrit's copy of a project into a bare local copy."""
+    u.ensure_dir(os.path.dirname(repo_path))
+    clone_opts = ""
+    if reference:
+        # Copy what is borrowed, the local copy must not depend on a
+        # repository jeepyb does not look after
+        clone_opts += "--reference %s --dissociate " % reference
+    if partial:
+        clone_opts += "--filter=blob:none "
+    status = u.command_status(
+        "git clone --bare %s%s %s" % (
+            clone_opts, git_opts['remote_url'], repo_path),
+        env=ssh_env)
+    if status != 0:
+        raise Exception('git clone failed not importing')
+    # A bare clone copies Gerrit's branches to its own, keep them under
+    # refs/remotes/origin like a normal clone would
+    u.git_command(
+        repo_path,
+        "config remote.origin.fetch +refs/heads/*:refs/remotes/origin/*")
+    update_local_copy(repo_path, True, git_opts, ssh_env)
 
-    has_upstream_remote = (
-        'upstream' in u.git_command_output(repo_path, 'remote')[1])
+
+def update_local_copy(repo_path, track_upstream, git_opts, ssh_env):
+    with gitrepo.GitRepo(repo_path) as repo:
+        has_upstream_remote = 'upstream' in repo.remotes()
     if track_upstream:
         # If we're configured to track upstream but the repo
         # does not have an upstream remote, add one
@@ -88,30 +173,47 @@ def update_local_copy(repo_path, track_upstream, git_opts, ssh_env):
                 repo_path,
                 "remote set-url upstream %(upstream)s" % git_opts)
 
+        # Fetch every upstream tag, not only the ones on a fetched
+        # branch, or the tags on no branch are never pushed and the
+        # project never looks up to date.  Tags fetched this way are not
+        # pruned.
+        u.git_command(repo_path, "config remote.upstream.tagOpt --tags")
+
         # Now that we have any upstreams configured, fetch all of the refs
-        # we might need, pruning remote branches that no longer exist
-        u.git_command(
-            repo_path, "remote update --prune", env=ssh_env)
+        # we might need, pruning remote branches that no longer exist.
+        # Objects that fail fetch.fsckObjects make the fetch fail.
+        if u.git_command(
+                repo_path, "remote update --prune", env=ssh_env) != 0:
+            raise Exception('git fetch failed not importing')
     else:
         # If we are not tracking upstream, then we do not need
         # an upstream remote configured
         if has_upstream_remote:
             u.git_command(repo_path, "remote rm upstream")
 
-    # TODO(mordred): This is here so that later we can
-    # inspect the master branch for meta-info
-    # Checkout master and reset to the state of origin/master
-    u.git_command(repo_path, "checkout -B master origin/master")
+    # Local branches are left over from the bare clone or from the
+    # working tree copies, nothing uses them
+    prune_refs(repo_path, 'refs/heads/')
+
 
+def maintain_repo(repo_path, interval):
+    """Keep fetching from and pushing out of repo_path fast as it grows.
 
-def fsck_repo(repo_path):
-    rc, out = u.git_command_output(repo_path, 'fsck --full')
-    # Check for non zero return code or warnings which should
-    # be treated as errors. In this case zeroPaddedFilemodes
-    # will not be accepted by Gerrit/jgit but are accepted by C git.
-    if rc != 0 or 'zeroPaddedFilemode' in out:
-        log.error('git fsck of %s failed:\n%s' % (repo_path, out))
-        raise Exception('git fsck failed not importing')
+    Returns True if the periodic maintenance ran, which is at most once
+    every interval seconds.
+    """
+    u.git_command(repo_path, "-c gc.autoDetach=false gc --auto")
+    since = u.seconds_since(repo_path, 'jeepyb.lastmaintenance')
+    if since is not None and since < interval:
+        return False
+    # refs/copy/* only carry the first import to Gerrit
+    pruned = prune_refs(repo_path, 'refs/copy/')
+    if pruned:
+        log.info("Removed %d refs/copy refs from %s" % (pruned, repo_path))
+    u.git_command(repo_path, "commit-graph write --reachable --split")
+    u.git_command(repo_path, "multi-pack-index write")
+    u.record_time(repo_path, 'jeepyb.lastmaintenance')
+    return True
 
 
 def push_to_gerrit(repo_path, project, push_string, remote_url, ssh_env):
@@ -123,40 +225,108 @@ def push_to_gerrit(repo_path, project, push_string, remote_url, ssh_env):
             "Error pushing %s to Gerrit." % project)
 
 
-def sync_upstream(repo_path, project, ssh_env, upstream_prefix):
-    u.git_command(
-        repo_path,
-        "remote update upstream --prune", env=ssh_env)
-    # Any branch that exists in the upstream remote, we want
-    # a local branch of, optionally prefixed with the
-    # upstream prefix value
-    for branch in u.git_command_output(
-            repo_path, "branch -a")[1].split('\n'):
-        if not branch.strip().startswith("remotes/upstream"):
-            continue
-        if "->" in branch:
-            continue
-        local_branch = branch.split()[0][len('remotes/upstream/'):]
-        if upstream_prefix:
-            local_branch = "%s/%s" % (
-                upstream_prefix, local_branch)
-
-        # Check out an up to date copy of the branch, so that
-        # we can push it and it will get picked up below
-        u.git_command(
-            repo_path, "checkout -B %s %s" % (local_branch, branch))
-
-    try:
-        # Push all of the local branches to similarly named
-        # Branches on gerrit. Also, push all of the tags
-        u.git_command(
-            repo_path,
-            "push origin refs/heads/*:refs/heads/*",
-            env=ssh_env)
-        u.git_command(repo_path, 'push origin --tags', env=ssh_env)
-    except Exception:
-        log.exception(
-            "Error pushing %s to Gerrit." % project)
+def upstream_host(upstream):
+    """Return the host an upstream URL is fetched from."""
+    if not upstream:
+        return None
+    parsed = urlparse.urlparse(upstream)
+    if parsed.netloc:
+        return parsed.hostname
+    if parsed.scheme == 'file':
+        return 'localhost'
+    # scp-like syntax, [user@]host:path, as long as there is no slash
+    # before the colon
+    match = re.match(r'^(?:[^@/]+@)?([^:/]+):', upstream)
+    if match:
+        return match.group(1)
+    return 'localhost'
+
+
+class FetchScheduler(object):
+    """Hand out projects to fetch, at most limit per upstream host.
+
+    Hosts take turns, so a long list of projects from one host does not
+    keep the fetchers from starting on the other hosts.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._pending = collections.OrderedDict()
+        self._active = collections.defaultdict(int)
+        self._cond = threading.Condition()
+
+    def add(self, host, item):
+        with self._cond:
+            self._pending.setdefault(host, collections.deque()).append(item)
+            self._cond.notify()
+
+    def take(self):
+        """Return (host, item) to fetch next, or None when all are taken.
+
+        Blocks while every host with projects left is at its limit.  The
+        caller calls release(host) when the fetch is over.
+        """
+        with self._cond:
+            while self._pending:
+                for host in list(self._pending):
+                    if self._active[host] < self.limit:
+                        items = self._pending.pop(host)
+                        item = items.popleft()
+                        if items:
+                            # Back of the line for the next turn
+                            self._pending[host] = items
+                        self._active[host] += 1
+                        return host, item
+                self._cond.wait()
+            return None
+
+    def release(self, host):
+        with self._cond:
+            self._active[host] -= 1
+            self._cond.notify_all()
+
+
+class Timings(object):
+    """How long each project spent in each stage."""
+
+    STAGES = ('queued', 'fetch', 'fsck', 'push', 'maint')
+
+    def __init__(self):
+        self.projects = collections.OrderedDict()
+        self.failed = set()
+        self.skipped = set()
+        self._lock = threading.Lock()
+
+    def record(self, project, stage, seconds):
+        with self._lock:
+            self.projects.setdefault(project, {})[stage] = seconds
+
+    def fail(self, project):
+        with self._lock:
+            self.failed.add(project)
+
+    def skip(self, project):
+        with self._lock:
+            self.skipped.add(project)
+
+    def report(self):
+        if not self.projects:
+            return
+        lines = [("%-40s" + " %8s" * (len(self.STAGES) + 1)) %
+                 (('project',) + self.STAGES + ('total',))]
+        for project, stages in sorted(
+                self.projects.items(),
+                key=lambda item: -sum(item[1].values())):
+            lines.append("%-40s %s %8.1f%s" % (
+                project,
+                ' '.join('%8s' % ('%.1f' % stages[stage]
+                                  if stage in stages else '-')
+                         for stage in self.STAGES),
+                sum(stages.values()),
+                ' FAILED' if project in self.failed else
+                ' up to date' if project in self.skipped else ''))
+        log.info("Timings of %d projects (seconds):\n%s" %
+                 (len(self.projects), '\n'.join(lines)))
 
 
 def main():
@@ -164,11 +334,21 @@ def main():
     l.setup_logging_arguments(parser)
     parser.add_argument('--nocleanup', action='store_true',
                         help='do not remove temp directories')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of projects fetched concurrently')
+    parser.add_argument('--per-host-limit', type=int, default=2,
+                        help='fetches from the same upstream host at a '
+                             'time (default: %(default)s)')
+    parser.add_argument('--local-workers', type=int, default=4,
+                        help='number of projects checked and pushed to '
+                             'Gerrit concurrently')
     parser.add_argument('projects', metavar='project', nargs='*',
                         help='name of project(s) to process')
     args = parser.parse_args()
     l.configure_logging(args)
 
+    registry = u.ProjectsRegistry()
+
     JEEPYB_CACHE_DIR = registry.get_defaults('jeepyb-cache-dir',
                                              '/var/lib/jeepyb')
     IMPORT_DIR = os.path.join(JEEPYB_CACHE_DIR, 'import')
@@ -176,74 +356,145 @@ def main():
     GERRIT_PORT = int(registry.get_defaults('gerrit-port', '29418'))
     GERRIT_USER = registry.get_defaults('gerrit-user')
     GERRIT_KEY = registry.get_defaults('gerrit-key')
-    GERRIT_GITID = registry.get_defaults('gerrit-committer')
-
-    PROJECT_CACHE_FILE = os.path.join(JEEPYB_CACHE_DIR, 'project.cache')
-    project_cache = {}
-    if os.path.exists(PROJECT_CACHE_FILE):
-        project_cache = json.loads(open(PROJECT_CACHE_FILE, 'r').read())
-
-    gerrit = gerritlib.gerrit.Gerrit(GERRIT_HOST,
-                                     GERRIT_USER,
-                                     GERRIT_PORT,
-                                     GERRIT_KEY)
-    project_list = gerrit.listProjects()
-    ssh_env = u.make_ssh_wrapper(GERRIT_USER, GERRIT_KEY)
-    try:
+    SSH_MULTIPLEX = registry.get_defaults('ssh-multiplex', True)
+    SSH_CONTROL_DIR = os.path.join(JEEPYB_CACHE_DIR, 'ssh')
+    FULL_FSCK_INTERVAL = int(
+        float(registry.get_defaults('full-fsck-days', 7)) * 24 * 60 * 60)
+    MAINTENANCE_INTERVAL = int(
+        float(registry.get_defaults('maintenance-days', 1)) * 24 * 60 * 60)
+
+    project_cache = jeepyb.cache.ProjectCache(JEEPYB_CACHE_DIR)
+
+    ssh_env = u.make_ssh_wrapper(
+        GERRIT_USER, GERRIT_KEY,
+        control_dir=SSH_CONTROL_DIR if SSH_MULTIPLEX else None)
+    scheduler = FetchScheduler(args.per_host_limit)
+    timings = Timings()
+    local_pool = multiprocessing.pool.ThreadPool(args.local_workers)
+
+    def maintain(project, repo_path):
+        try:
+            start = time.time()
+            if maintain_repo(repo_path, MAINTENANCE_INTERVAL):
+                log.info("Maintained %s: %s" %
+                         (project, u.describe_objects(repo_path)))
+            timings.record(project, 'maint', time.time() - start)
+        except Exception:
+            log.exception("Problems maintaining %s" % project)
+
+    def sync(project, repo_path, remote_url, upstream_prefix):
+        try:
+            start = time.time()
+            u.fsck_repo(repo_path, FULL_FSCK_INTERVAL)
+            timings.record(project, 'fsck', time.time() - start)
+            start = time.time()
+            pushed = jeepyb.upstream.sync_upstream(
+                repo_path, project, remote_url, ssh_env, upstream_prefix)
+            timings.record(project, 'push', time.time() - start)
+            log.info("Synced %d refs of %s: %s" %
+                     (len(pushed), project, u.describe_objects(repo_path)))
+        except Exception:
+            timings.fail(project)
+            log.exception(
+                "Problems creating %s, moving on." % project)
+        maintain(project, repo_path)
+
+    def fetch(work, queued):
+        project, section, upstream_prefix, repo_path, git_opts = work
+        upstream = git_opts['upstream']
+        timings.record(project, 'queued', time.time() - queued)
+        log.info("Fetching project: %s" % project)
+        start = time.time()
+        remote_url = git_opts['remote_url']
+        try:
+            if needs_conversion(repo_path):
+                convert_to_bare(repo_path)
+            # Make Local repo
+            if not os.path.exists(repo_path):
+                import_mode, reference = jeepyb.upstream.import_mode(
+                    section)
+                make_local_copy(
+                    repo_path, git_opts, ssh_env, reference=reference,
+                    partial=import_mode == 'partial')
+            elif not jeepyb.upstream.pending_refs(
+                    repo_path, upstream, remote_url, upstream_prefix,
+                    ssh_env):
+                log.info("%s is up to date with upstream" % project)
+                timings.skip(project)
+                local_pool.apply_async(maintain, (project, repo_path))
+                return
+            else:
+                update_local_copy(
+                    repo_path, True, git_opts, ssh_env)
+        except Exception:
+            timings.fail(project)
+            log.exception(
+                "Problems creating %s, moving on." % project)
+            return
+        finally:
+            timings.record(project, 'fetch', time.time() - start)
+        local_pool.apply_async(
+            sync, (project, repo_path, remote_url, upstream_prefix))
+
+    def fetcher():
+        while True:
+            taken = scheduler.take()
+            if taken is None:
+                return
+            host, (work, queued) = taken
+            try:
+                fetch(work, queued)
+            finally:
+                scheduler.release(host)
 
-        for section in registry.configs_list:
-            project = section['project']
+    try:
+        queued = time.time()
+        for project in registry.projects_with_option('track-upstream'):
+            section = registry[project]
             if args.projects and project not in args.projects:
                 continue
 
-            try:
-                log.info("Processing project: %s" % project)
-
-                # Figure out all of the options
-                options = section.get('options', dict())
-                track_upstream = 'track-upstream' in options
-                if not track_upstream:
-                    continue
-
-                # If this project doesn't want to use gerrit, exit cleanly.
-                if 'no-gerrit' in options:
-                    continue
-
-                upstream = section.get('upstream', None)
-                upstream_prefix = section.get('upstream-prefix', None)
-                repo_path = os.path.join(IMPORT_DIR, project)
-
-                project_git = "%s.git" % project
-                remote_url = "ssh://%s:%s/%s" % (
-                    GERRIT_HOST,
-                    GERRIT_PORT,
-                    project)
-                git_opts = dict(upstream=upstream,
-                                repo_path=repo_path,
-                                remote_url=remote_url)
-                project_cache.setdefault(project, {})
-                if not project_cache[project]['pushed-to-gerrit']:
-                    continue
-
-                # Make Local repo
-                if not os.path.exists(repo_path):
-                    u.make_local_copy(
-                        repo_path, project, project_list,
-                        git_opts, ssh_env, upstream, GERRIT_HOST,
-                        GERRIT_PORT, project_git, GERRIT_GITID)
-                else:
-                    update_local_copy(
-                        repo_path, track_upstream, git_opts, ssh_env)
-
-                fsck_repo(repo_path)
-                sync_upstream(repo_path, project, ssh_env, upstream_prefix)
-
-            except Exception:
-                log.exception(
-                    "Problems creating %s, moving on." % project)
+            # Figure out all of the options
+            options = section.get('options', dict())
+
+            # If this project doesn't want to use gerrit, exit cleanly.
+            if 'no-gerrit' in options:
+                continue
+            if not project_cache.get(project).get('pushed-to-gerrit'):
                 continue
+
+            upstream = section.get('upstream', None)
+            upstream_prefix = section.get('upstream-prefix', None)
+            repo_path = os.path.join(IMPORT_DIR, project)
+            remote_url = "ssh://%s:%s/%s" % (
+                GERRIT_HOST,
+                GERRIT_PORT,
+                project)
+            git_opts = dict(upstream=upstream,
+                            repo_path=repo_path,
+                            remote_url=remote_url)
+            scheduler.add(upstream_host(upstream),
+                          ((project, section, upstream_prefix, repo_path,
+                            git_opts), queued))
+
+        fetchers = []
+        for i in range(max(args.workers, 1)):
+            thread = threading.Thread(target=fetcher,
+                                      name='fetch-%d' % i)
+            thread.daemon = True
+            thread.start()
+            fetchers.append(thread)
+        for thread in fetchers:
+            # A timeout keeps the main thread responsive to ^C
+            while thread.is_alive():
+                thread.join(1)
+        local_pool.close()
+        local_pool.join()
+        timings.report()
     finally:
-        os.unlink(ssh_env['GIT_SSH'])
+        local_pool.terminate()
+        project_cache.close()
+        u.cleanup_ssh_wrapper(ssh_env)
 
 if __name__ == "__main__":
     main()
@@ -140,8 +140,16 @@ def GetApprovals(options):
     return approvals
 
 
-def GetPatchId(revision, consider_whitespace=False):
-    git_show_cmd = ['git', 'show', revision]
+def GitCommand(git_dir, *args):
+    """Returns a git command line, run against git_dir if it is set."""
+    git_cmd = ['git']
+    if git_dir:
+        git_cmd.append('--git-dir=%s' % git_dir)
+    return git_cmd + list(args)
+
+
+def GetPatchId(revision, consider_whitespace=False, git_dir=None):
+    git_show_cmd = GitCommand(git_dir, 'show', revision)
     patch_id_cmd = ['git', 'patch-id']
     patch_id_process = subprocess.Popen(patch_id_cmd, stdout=subprocess.PIPE,
                                         stdin=subprocess.PIPE)
@@ -167,19 +175,19 @@ def SuExec(options, as_user, cmd):
     Gssh(options, suexec_cmd)
 
 
-def DiffCommitMessages(commit1, commit2):
-    log_cmd1 = ['git', 'log', '--pretty=format:"%an %ae%n%s%n%b"',
-                commit1 + '^!']
+def DiffCommitMessages(commit1, commit2, git_dir=None):
+    log_cmd1 = GitCommand(git_dir, 'log', '--pretty=format:"%an %ae%n%s%n%b"',
+                          commit1 + '^!')
     commit1_log = CheckCall(log_cmd1)
-    log_cmd2 = ['git', 'log', '--pretty=format:"%an %ae%n%s%n%b"',
-                commit2 + '^!']
+    log_cmd2 = GitCommand(git_dir, 'log', '--pretty=format:"%an %ae%n%s%n%b"',
+                          commit2 + '^!')
     commit2_log = CheckCall(log_cmd2)
     if commit1_log != commit2_log:
         return True
     return False
 
 
-def main():
+def GetParser():
     usage = "usage: %prog <required options> [optional options]"
     parser = SilentOptionParser(usage=usage)
     parser.add_option("--change", dest="changeId", help="Change identifier")
@@ -198,34 +206,44 @@ def main():
                            "[default: %default]")
     parser.add_option("--whitespace", action="store_true",
                       help="Treat whitespace as significant")
+    parser.add_option("--git-dir", dest="git_dir",
+                      help="Git directory of the project "
+                           "[default: $GIT_DIR or the current directory]")
+    return parser
+
 
-    (options, args) = parser.parse_args()
+def parse_args(argv=None):
+    (options, args) = GetParser().parse_args(argv)
+    return options
 
+
+def process(options):
     if not options.changeId:
-        parser.print_help()
-        sys.exit(0)
+        return
 
     if options.patchset == 1:
         # Nothing to detect on first patchset
-        sys.exit(0)
+        return
     prev_revision = None
     prev_revision = FindPrevRev(options)
     if not prev_revision:
         # Couldn't find a previous revision
-        sys.exit(0)
-    prev_patch_id = GetPatchId(prev_revision)
-    cur_patch_id = GetPatchId(options.commit)
+        return
+    prev_patch_id = GetPatchId(prev_revision, git_dir=options.git_dir)
+    cur_patch_id = GetPatchId(options.commit, git_dir=options.git_dir)
     if cur_patch_id.split()[0] != prev_patch_id.split()[0]:
         # patch-ids don't match
-        sys.exit(0)
+        return
     # Patch ids match. This is a trivial rebase.
     # In addition to patch-id we should check if whitespace content changed.
     # Some languages are more sensitive to whitespace than others, and some
     # changes may either introduce or be intended to fix style problems
     # specifically involving whitespace as well.
     if options.whitespace:
-        prev_patch_ws = GetPatchId(prev_revision, consider_whitespace=True)
-        cur_patch_ws = GetPatchId(options.commit, consider_whitespace=True)
+        prev_patch_ws = GetPatchId(prev_revision, consider_whitespace=True,
+                                   git_dir=options.git_dir)
+        cur_patch_ws = GetPatchId(options.commit, consider_whitespace=True,
+                                  git_dir=options.git_dir)
         if cur_patch_ws.split()[0] != prev_patch_ws.split()[0]:
             # Insert a comment into the change letting the approvers know
             # only the whitespace changed
@@ -234,11 +252,12 @@ def main():
             comment_cmd = ['gerrit', 'approve', '--project', options.project,
                            '--message', comment_msg, options.commit]
             SuExec(options, options.role_user, ' '.join(comment_cmd))
-            sys.exit(0)
+            return
 
     # We should also check if the commit message changed. Most approvers would
     # want to re-review changes when the commit message changes.
-    changed = DiffCommitMessages(prev_revision, options.commit)
+    changed = DiffCommitMessages(prev_revision, options.commit,
+                                 git_dir=options.git_dir)
     if changed:
         # Insert a comment into the change letting the approvers know only the
         # commit message changed
@@ -247,7 +266,7 @@ def main():
         comment_cmd = ['gerrit', 'approve', '--project', options.project,
                        '--message', comment_msg, options.commit]
         SuExec(options, options.role_user, ' '.join(comment_cmd))
-        sys.exit(0)
+        return
 
     # Need to get all approvals on prior patch set, then suexec them onto
     # this patchset.
@@ -272,7 +291,7 @@ def main():
             continue
         else:
             print("Unsupported category: %s" % approval)
-            sys.exit(0)
+            return
 
         score = approval["value"]
         gerrit_approve_cmd = ['gerrit', 'approve',
@@ -280,6 +299,15 @@ def main():
                               '--message', gerrit_approve_msg,
                               approve_category, score, options.commit]
         SuExec(options, approval["account_id"], ' '.join(gerrit_approve_cmd))
+
+
+def main():
+    options = parse_args()
+    if not options.changeId:
+        GetParser().print_help()
+        sys.exit(0)
+
+    process(options)
     sys.exit(0)
 
 if __name__ == "__main__":
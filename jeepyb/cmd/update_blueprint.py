@@ -18,17 +18,13 @@
 # corresponding Launchpad blueprints with links back to the change.
 
 import argparse
-import ConfigParser
 import os
 import re
-import StringIO
 import subprocess
 
-from launchpadlib import launchpad
-from launchpadlib import uris
-import pymysql
-
+import jeepyb.queries
 from jeepyb import projects as p
+from jeepyb import utils as u
 
 
 BASE_DIR = '/home/gerrit2/review_site'
@@ -38,35 +34,10 @@ GERRIT_CACHE_DIR = os.path.expanduser(
 GERRIT_CREDENTIALS = os.path.expanduser(
     os.environ.get('GERRIT_CREDENTIALS',
                    '~/.launchpadlib/creds'))
-GERRIT_CONFIG = os.environ.get('GERRIT_CONFIG',
-                               '/home/gerrit2/review_site/etc/gerrit.config')
-GERRIT_SECURE_CONFIG_DEFAULT = '/home/gerrit2/review_site/etc/secure.config'
-GERRIT_SECURE_CONFIG = os.environ.get('GERRIT_SECURE_CONFIG',
-                                      GERRIT_SECURE_CONFIG_DEFAULT)
 SPEC_RE = re.compile(r'\b(blueprint|bp)\b[ \t]*[#:]?[ \t]*(\S+)', re.I)
 BODY_RE = re.compile(r'^\s+.*$')
 
 
-def get_broken_config(filename):
-    """gerrit config ini files are broken and have leading tabs."""
-    text = ""
-    with open(filename, "r") as conf:
-        for line in conf.readlines():
-            text = "%s%s" % (text, line.lstrip())
-
-    fp = StringIO.StringIO(text)
-    c = ConfigParser.ConfigParser()
-    c.readfp(fp)
-    return c
-
-GERRIT_CONFIG = get_broken_config(GERRIT_CONFIG)
-SECURE_CONFIG = get_broken_config(GERRIT_SECURE_CONFIG)
-DB_HOST = GERRIT_CONFIG.get("database", "hostname")
-DB_USER = GERRIT_CONFIG.get("database", "username")
-DB_PASS = SECURE_CONFIG.get("database", "password")
-DB_DB = GERRIT_CONFIG.get("database", "database")
-
-
 def update_spec(launchpad, project, name, subject, link, topic=None):
     spec = None
 
@@ -106,7 +77,7 @@ def update_spec(launchpad, project, name, subject, link, topic=None):
         spec.lp_save()
 
 
-def find_specs(launchpad, dbconn, args):
+def find_specs(launchpad, args):
     git_dir_arg = '--git-dir={base_dir}/git/{project}.git'.format(
         base_dir=BASE_DIR,
         project=args.project)
@@ -114,10 +85,8 @@ def find_specs(launchpad, dbconn, args):
                                 args.commit + '^1..' + args.commit],
                                stdout=subprocess.PIPE).communicate()[0]
 
-    cur = dbconn.cursor()
-    cur.execute("select subject, topic from changes where change_key=%s",
-                args.change)
-    subject, topic = cur.fetchone()
+    subject, topic = jeepyb.queries.change_subjects(
+        [args.change])[args.change]
     specs = set([m.group(2) for m in SPEC_RE.finditer(git_log)])
 
     if topic:
@@ -129,7 +98,7 @@ def find_specs(launchpad, dbconn, args):
                     args.change_url, topic)
 
 
-def main():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('hook')
     # common
@@ -152,16 +121,17 @@ def main():
     parser.add_argument('--is-draft', default=None)
     parser.add_argument('--kind', default=None)
 
-    args = parser.parse_args()
+    return parser.parse_args(argv)
+
 
-    lpconn = launchpad.Launchpad.login_with(
-        'Gerrit User Sync', uris.LPNET_SERVICE_ROOT, GERRIT_CACHE_DIR,
-        credentials_file=GERRIT_CREDENTIALS, version='devel')
+def process(args):
+    lpconn = u.launchpad_login(GERRIT_CACHE_DIR, GERRIT_CREDENTIALS)
 
-    conn = pymysql.connect(
-        host=DB_HOST, user=DB_USER, password=DB_PASS, db=DB_DB)
+    find_specs(lpconn, args)
 
-    find_specs(lpconn, conn, args)
+
+def main():
+    process(parse_args())
 
 if __name__ == "__main__":
     main()
@@ -22,10 +22,7 @@ import os
 import re
 import subprocess
 
-from launchpadlib import launchpad
-from launchpadlib import uris
-
-import jeepyb.gerritdb
+import jeepyb.queries
 from jeepyb import projects as p
 from jeepyb import utils as u
 
@@ -92,33 +89,9 @@ def set_in_progress(bugtask, launchpad, uploader, change_url):
     except ValueError:
         searchkey = uploader
 
-    # The counterintuitive query is due to odd database schema choices
-    # in Gerrit. For example, an account with a secondary E-mail
-    # address added looks like...
-    # select email_address,external_id from account_external_ids
-    #     where account_id=1234;
-    # +-----------------+-----------------------------------------+
-    # | email_address   | external_id                             |
-    # +-----------------+-----------------------------------------+
-    # | plugh@xyzzy.com | https://login.ubuntu.com/+id/fR0bnU1 |
-    # | bar@foo.org     | mailto:bar@foo.org                      |
-    # | NULL            | username:quux                           |
-    # +-----------------+-----------------------------------------+
-    # ...thus we need a join on a secondary query to search against
-    # all the user's configured E-mail addresses.
-    #
-    query = """SELECT t.external_id FROM account_external_ids t
-            INNER JOIN (
-                SELECT t.account_id FROM account_external_ids t
-                WHERE t.email_address = %s )
-            original ON t.account_id = original.account_id
-            AND t.external_id LIKE 'https://login.ubuntu.com%%'"""
-
-    cursor = jeepyb.gerritdb.connect().cursor()
-    cursor.execute(query, searchkey)
-    data = cursor.fetchone()
-    if data:
-        assignee = launchpad.people.getByOpenIDIdentifier(identifier=data[0])
+    openid = jeepyb.queries.launchpad_openids([searchkey]).get(searchkey)
+    if openid:
+        assignee = launchpad.people.getByOpenIDIdentifier(identifier=openid)
         if assignee:
             bugtask.assignee = assignee
 
@@ -331,7 +304,7 @@ def extract_git_log(args):
     return subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
 
 
-def main():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('hook')
     # common
@@ -354,12 +327,12 @@ def main():
     parser.add_argument('--is-draft', default=None)
     parser.add_argument('--kind', default=None)
 
-    args = parser.parse_args()
+    return parser.parse_args(argv)
+
 
+def process(args):
     # Connect to Launchpad.
-    lpconn = launchpad.Launchpad.login_with(
-        'Gerrit User Sync', uris.LPNET_SERVICE_ROOT, GERRIT_CACHE_DIR,
-        credentials_file=GERRIT_CREDENTIALS, version='devel')
+    lpconn = u.launchpad_login(GERRIT_CACHE_DIR, GERRIT_CREDENTIALS)
 
     # Get git log.
     git_log = extract_git_log(args)
@@ -369,5 +342,9 @@ def main():
         process_bugtask(lpconn, task, git_log, args)
 
 
+def main():
+    process(parse_args())
+
+
 if __name__ == "__main__":
     main()
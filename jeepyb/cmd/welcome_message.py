@@ -28,10 +28,9 @@
 
 import argparse
 import logging
-import paramiko
 
-import jeepyb.gerritdb
 import jeepyb.log as l
+import jeepyb.queries
 
 BASE_DIR = '/home/gerrit2/review_site'
 
@@ -48,22 +47,11 @@ def is_newbie(uploader):
         logger.info('Couldnt get email for %s', uploader)
         return False
 
-    # this query looks for all distinct patchsets for the given
-    # user. If there's only 1, they're a first-timer.
-    query = """SELECT COUNT(DISTINCT p.change_id + p.patch_set_id)
-               FROM patch_sets p, account_external_ids a
-               WHERE a.email_address = %s
-               AND a.account_id = p.uploader_account_id;"""
-
-    cursor = jeepyb.gerritdb.connect().cursor()
-    cursor.execute(query, searchkey)
-    data = cursor.fetchone()
-    if data:
-        if data[0] == 1:
-            logger.info('We found a newbie: %s', uploader)
-            return True
-        else:
-            return False
+    # If they uploaded just this one patchset, they're a first-timer.
+    if jeepyb.queries.patchset_counts([searchkey])[searchkey] == 1:
+        logger.info('We found a newbie: %s', uploader)
+        return True
+    return False
 
 
 def post_message(commit, gerrit_user, gerrit_ssh_key, message_file):
@@ -111,6 +99,8 @@ def post_message(commit, gerrit_user, gerrit_ssh_key, message_file):
                    message=welcome_text,
                    commit=commit)
     logger.info('Welcoming: %s', commit)
+    # paramiko is slow to import and most events welcome nobody
+    import paramiko
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     ssh.connect('localhost', username=gerrit_user,
@@ -125,7 +115,7 @@ def post_message(commit, gerrit_user, gerrit_ssh_key, message_file):
         logger.error('stderr: %s' % stderr_text)
 
 
-def main():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('hook')
     # common
@@ -160,14 +150,22 @@ def main():
     parser.set_defaults(dryrun=False)
     l.setup_logging_arguments(parser)
 
-    args = parser.parse_args()
+    return parser.parse_args(argv)
 
-    l.configure_logging(args)
 
+def process(args):
     # they're a first-timer, post the message on 1st patchset
     if is_newbie(args.uploader) and args.patchset == '1' and not args.dryrun:
         post_message(args.commit, args.ssh_user, args.ssh_key,
                      args.message_file)
 
+
+def main():
+    args = parse_args()
+
+    l.configure_logging(args)
+
+    process(args)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,96 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Run work on a fixed set of threads, in order for work with the same key.
+
+Every key (a Gerrit change, say) is always handed to the same worker
+thread, so the work for one key runs one item at a time and in the order
+it was submitted, while work for different keys runs concurrently.
+"""
+
+import logging
+import Queue
+import threading
+
+log = logging.getLogger("jeepyb.dispatch")
+
+
+class Job(object):
+
+    def __init__(self, key, func, args):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.error = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Wait for the job to finish, return whether it has."""
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+
+class Dispatcher(object):
+
+    def __init__(self, workers=4, queue_size=0, name='worker'):
+        """Start workers threads.
+
+        queue_size bounds the backlog of each worker; once a worker's
+        queue is full, submit() blocks until it has room.
+        """
+        self.queues = [Queue.Queue(queue_size) for i in range(workers)]
+        self.threads = []
+        for i, queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._run, args=(queue,),
+                                      name='%s-%d' % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self, queue):
+        while True:
+            job = queue.get()
+            try:
+                if job is None:
+                    return
+                job.func(*job.args)
+            except Exception as e:
+                log.exception("Job for %s failed" % job.key)
+                job.error = str(e) or e.__class__.__name__
+            except SystemExit as e:
+                # A handler giving up must not take the worker with it
+                if e.code:
+                    job.error = "exited with %s" % e.code
+            finally:
+                if job is not None:
+                    job._done.set()
+                queue.task_done()
+
+    def submit(self, key, func, *args):
+        """Queue func(*args) on the worker for key and return its Job."""
+        job = Job(key, func, args)
+        self.queues[hash(key) % len(self.queues)].put(job)
+        return job
+
+    def backlog(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def stop(self):
+        """Let the workers finish the queued jobs, then stop them."""
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -14,9 +14,13 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import contextlib
 import ConfigParser
+import logging
 import os
 import StringIO
+import threading
+import time
 
 
 GERRIT_CONFIG = os.environ.get(
@@ -25,46 +29,177 @@ GERRIT_CONFIG = os.environ.get(
 GERRIT_SECURE_CONFIG = os.environ.get(
     'GERRIT_SECURE_CONFIG',
     '/home/gerrit2/review_site/etc/secure.config')
-db_connection = None
+POOL_SIZE = int(os.environ.get('JEEPYB_DB_POOL_SIZE', 4))
+POOL_IDLE_TIMEOUT = int(os.environ.get('JEEPYB_DB_IDLE_TIMEOUT', 300))
+
+log = logging.getLogger("jeepyb.gerritdb")
+_pool = None
+_pool_lock = threading.Lock()
+# filename -> ((mtime, size), parsed config)
+_configs = {}
+_config_lock = threading.Lock()
 
 
 def get_broken_config(filename):
-    """gerrit config ini files are broken and have leading tabs."""
-    text = ""
-    for line in open(filename, "r"):
-        text += line.lstrip()
+    """gerrit config ini files are broken and have leading tabs.
+
+    Parsed files are kept until their mtime or size changes, so the
+    returned ConfigParser is shared and must not be modified.
+    """
+    st = os.stat(filename)
+    stamp = (st.st_mtime, st.st_size)
+    with _config_lock:
+        cached = _configs.get(filename)
+        if cached and cached[0] == stamp:
+            return cached[1]
 
-    fp = StringIO.StringIO(text)
+    with open(filename, "r") as conf:
+        text = "".join(line.lstrip() for line in conf)
     c = ConfigParser.ConfigParser()
-    c.readfp(fp)
+    c.readfp(StringIO.StringIO(text))
+
+    with _config_lock:
+        _configs[filename] = (stamp, c)
     return c
 
 
-def connect():
-    global db_connection
-    if not db_connection:
-        gerrit_config = get_broken_config(GERRIT_CONFIG)
-        secure_config = get_broken_config(GERRIT_SECURE_CONFIG)
-
-        DB_TYPE = gerrit_config.get("database", "type")
-        DB_HOST = gerrit_config.get("database", "hostname")
-        DB_USER = gerrit_config.get("database", "username")
-        DB_PASS = secure_config.get("database", "password")
-        DB_DB = gerrit_config.get("database", "database")
-
-        if DB_TYPE.upper() == "MYSQL":
-            import pymysql
-            db_connection = pymysql.connect(
-                host=DB_HOST, user=DB_USER, password=DB_PASS, db=DB_DB)
-        else:
-            import psycopg2
-            db_connection = psycopg2.connect(
-                host=DB_HOST, user=DB_USER, password=DB_PASS, database=DB_DB)
+def _connect():
+    gerrit_config = get_broken_config(GERRIT_CONFIG)
+    secure_config = get_broken_config(GERRIT_SECURE_CONFIG)
+
+    DB_TYPE = gerrit_config.get("database", "type")
+    DB_HOST = gerrit_config.get("database", "hostname")
+    DB_USER = gerrit_config.get("database", "username")
+    DB_PASS = secure_config.get("database", "password")
+    DB_DB = gerrit_config.get("database", "database")
+
+    if DB_TYPE.upper() == "MYSQL":
+        import pymysql
+        return pymysql.connect(
+            host=DB_HOST, user=DB_USER, password=DB_PASS, db=DB_DB)
     else:
+        import psycopg2
+        return psycopg2.connect(
+            host=DB_HOST, user=DB_USER, password=DB_PASS, database=DB_DB)
+
+
+def _alive(con):
+    try:
+        cursor = con.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        cursor.close()
+        return True
+    except Exception:
+        return False
+
+
+def _close(con):
+    try:
+        con.close()
+    except Exception:
+        pass
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of at most size database connections.
+
+    Connections that sat idle for longer than idle_timeout seconds are
+    closed instead of reused.  A connection is only checked when it is
+    taken from the pool after more than check_after seconds of idling,
+    so connections in steady use are never pinged.
+    """
+
+    def __init__(self, size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+                 check_after=30, connect=_connect):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self._connect = connect
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        # (connection, time it was returned), most recently used last
+        self._idle = []
+
+    def get(self):
+        """Take a connection out of the pool, waiting for one if needed."""
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    con, returned = self._idle.pop()
+                idle_for = time.time() - returned
+                if idle_for > self.idle_timeout:
+                    _close(con)
+                elif idle_for <= self.check_after or _alive(con):
+                    return con
+                else:
+                    log.debug("Dropping a dead database connection")
+                    _close(con)
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def put(self, con, broken=False):
+        """Give back a connection from get()."""
         try:
-            # Make sure the database is responding and reconnect if not
-            db_connection.ping(True)
-        except AttributeError:
-            # This database driver lacks a ping implementation
-            pass
-    return db_connection
+            if broken:
+                _close(con)
+                return
+            with self._lock:
+                self._idle.append((con, time.time()))
+        finally:
+            self._slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Use a connection from the pool for the duration of a block.
+
+        The transaction is committed when the block succeeds and rolled
+        back otherwise, so the next user starts with a fresh snapshot.
+        """
+        con = self.get()
+        try:
+            yield con
+            con.commit()
+        except Exception:
+            try:
+                con.rollback()
+            except Exception:
+                self.put(con, broken=True)
+                raise
+            self.put(con)
+            raise
+        self.put(con)
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for con, returned in idle:
+            _close(con)
+
+
+def configure(size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+    """Replace the shared pool with one of the given size and timeout."""
+    global _pool
+    with _pool_lock:
+        if _pool:
+            _pool.close()
+        _pool = ConnectionPool(size, idle_timeout)
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
+
+
+def connection():
+    """Use a connection from the shared pool, see ConnectionPool."""
+    return get_pool().connection()
@@ -0,0 +1,130 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Read-only access to local git repositories without a git per query.
+
+Refs are read straight from packed-refs and the loose ref files, remotes
+from the repository's config file.  Object lookups go through a single
+long-lived ``git cat-file --batch-check`` process per repository.
+Anything that talks to the network or changes the repository should keep
+using the helpers in jeepyb.utils.
+"""
+
+import logging
+import os
+import re
+import subprocess
+
+log = logging.getLogger("jeepyb.gitrepo")
+
+REMOTE_SECTION_RE = re.compile(r'^\s*\[remote\s+"(?P<name>[^"]+)"\]')
+SECTION_RE = re.compile(r'^\s*\[')
+KEY_VALUE_RE = re.compile(r'^\s*(?P<key>[\w-]+)\s*=\s*(?P<value>.*?)\s*$')
+
+
+class GitRepo(object):
+
+    def __init__(self, path):
+        git_dir = os.path.join(path, '.git')
+        if os.path.isdir(git_dir):
+            self.git_dir = git_dir
+        else:
+            # A bare repository
+            self.git_dir = path
+        self._batch = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._batch:
+            self._batch.stdin.close()
+            self._batch.wait()
+            self._batch = None
+
+    def refs(self, prefix='refs/'):
+        """Return a dict of ref name to sha for the refs below prefix.
+
+        Symbolic refs (like refs/remotes/origin/HEAD) are left out.
+        """
+        refs = {}
+        packed_refs = os.path.join(self.git_dir, 'packed-refs')
+        if os.path.exists(packed_refs):
+            with open(packed_refs, 'r') as packed:
+                for line in packed:
+                    if line.startswith('#') or line.startswith('^'):
+                        continue
+                    sha, name = line.split()
+                    if name.startswith(prefix):
+                        refs[name] = sha
+
+        # Loose refs take precedence over packed ones.  Only the
+        # directory holding prefix needs to be looked at.
+        refs_dir = os.path.join(self.git_dir, prefix.rsplit('/', 1)[0])
+        for dirpath, dirnames, filenames in os.walk(refs_dir):
+            for filename in filenames:
+                if filename.endswith('.lock'):
+                    # A ref being updated by a running git
+                    continue
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.git_dir).replace(
+                    os.sep, '/')
+                if not name.startswith(prefix):
+                    continue
+                with open(path, 'r') as ref_file:
+                    value = ref_file.read().strip()
+                if value and not value.startswith('ref:'):
+                    refs[name] = value
+        return refs
+
+    def remotes(self):
+        """Return a dict of remote name to its settings (url, fetch...)."""
+        remotes = {}
+        current = None
+        config = os.path.join(self.git_dir, 'config')
+        if not os.path.exists(config):
+            return remotes
+        with open(config, 'r') as config_file:
+            for line in config_file:
+                m = REMOTE_SECTION_RE.match(line)
+                if m:
+                    current = remotes.setdefault(m.group('name'), {})
+                    continue
+                if SECTION_RE.match(line):
+                    current = None
+                    continue
+                m = KEY_VALUE_RE.match(line)
+                if m and current is not None:
+                    current[m.group('key').lower()] = m.group('value')
+        return remotes
+
+    def rev_parse(self, rev):
+        """Return the object id rev names, or None if there is none.
+
+        rev can be anything git accepts for an object, including
+        "<commit>^{tree}" and "<tree-ish>:<path>".
+        """
+        if self._batch is None:
+            self._batch = subprocess.Popen(
+                ['git', '--git-dir=%s' % self.git_dir, 'cat-file',
+                 '--batch-check'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._batch.stdin.write(('%s\n' % rev).encode('utf-8'))
+        self._batch.stdin.flush()
+        header = self._batch.stdout.readline().decode('utf-8').split()
+        if len(header) != 3:
+            # "<rev> missing" or "<rev> ambiguous"
+            return None
+        return header[0]
@@ -0,0 +1,112 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Shared pieces of the hook server and its client.
+
+The hook scripts are run with the same arguments they get from Gerrit,
+either by the hook server or, when it is not running, by the client
+itself.  Each hook module provides parse_args(argv) and process(args).
+
+The client and server exchange one JSON object per line over a Unix
+socket.  The client sends {"hook": ..., "argv": [...], "git_dir": ...,
+"wait": bool} and the server answers {"status": "queued"} or, when the
+client asked to wait, {"status": "done"}; failures add an "error".
+"""
+
+import importlib
+import json
+import os
+import socket
+import sys
+
+HOOKS = {
+    'notify-impact': 'jeepyb.cmd.notify_impact',
+    'trivial-rebase': 'jeepyb.cmd.trivial_rebase',
+    'update-blueprint': 'jeepyb.cmd.update_blueprint',
+    'update-bug': 'jeepyb.cmd.update_bug',
+    'welcome-message': 'jeepyb.cmd.welcome_message',
+}
+DEFAULT_SOCKET = os.environ.get(
+    'JEEPYB_HOOK_SOCKET', '/home/gerrit2/review_site/tmp/jeepyb-hooks.sock')
+
+
+class HookError(Exception):
+    pass
+
+
+class ServerUnavailable(Exception):
+    pass
+
+
+def load_hooks(names=None):
+    """Import the hook modules, return a dict of hook name to module.
+
+    Every hook is loaded unless names lists the ones needed.
+    """
+    if names is None:
+        names = HOOKS.keys()
+    return dict((name, importlib.import_module(HOOKS[name]))
+                for name in names)
+
+
+def change_key(args):
+    """The key that keeps the events of one change in order."""
+    for name in ('change', 'changeId', 'project'):
+        key = getattr(args, name, None)
+        if key:
+            return key
+    return None
+
+
+def dispatch(dispatcher, modules, hook, argv, git_dir=None):
+    """Parse argv for hook and queue it on dispatcher, return the Job."""
+    if hook not in modules:
+        raise HookError('unknown hook %s' % hook)
+    module = modules[hook]
+    try:
+        args = module.parse_args(argv)
+    except SystemExit:
+        raise HookError('invalid arguments for %s: %s' %
+                        (hook, ' '.join(argv)))
+    # Hooks that work on the repository Gerrit ran them for get its path
+    if getattr(args, 'git_dir', False) is None:
+        args.git_dir = git_dir
+    return dispatcher.submit(change_key(args), module.process, args)
+
+
+def send_request(socket_path, request, timeout=None):
+    """Send request to the hook server and return its reply.
+
+    Raises ServerUnavailable if the server could not be reached, in which
+    case nothing was sent.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(socket_path)
+        except socket.error as e:
+            raise ServerUnavailable(str(e))
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        reply = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+    if not reply:
+        raise HookError('the hook server closed the connection')
+    return json.loads(reply.decode('utf-8'))
+
+
+def run_in_process(hook, argv):
+    """Run hook in this process, as if its script had been called."""
+    module = importlib.import_module(HOOKS[hook])
+    sys.argv = [hook] + list(argv)
+    module.main()
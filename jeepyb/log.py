@@ -13,7 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import logging
+import threading
 
 
 def setup_logging_arguments(parser):
@@ -35,3 +37,64 @@ def configure_logging(args):
     logging.basicConfig(level=level, filename=args.logfile,
                         format='%(asctime)-6s: %(name)s - %(levelname)s'
                                ' - %(message)s')
+
+
+class ProjectLogBuffer(logging.Filter):
+    """Hold back records logged by worker threads until they are flushed.
+
+    Worker threads call start() before processing a project and stop()
+    once they are done; everything logged in between is prefixed with the
+    project name and returned by stop() instead of being written out, so
+    that the caller can flush() the log of each project in one piece.
+    Only the last max_records records of a project are kept (a large
+    import logs every line git says under -d), with a note of how many
+    came before them.
+    """
+
+    def __init__(self, max_records=1000):
+        logging.Filter.__init__(self)
+        self.max_records = max_records
+        self._local = threading.local()
+
+    def install(self):
+        for handler in logging.getLogger().handlers:
+            handler.addFilter(self)
+
+    def uninstall(self):
+        for handler in logging.getLogger().handlers:
+            handler.removeFilter(self)
+
+    def start(self, name):
+        self._local.name = name
+        self._local.records = collections.deque(maxlen=self.max_records)
+        self._local.dropped = 0
+
+    def stop(self):
+        records = list(getattr(self._local, 'records', None) or [])
+        dropped = getattr(self._local, 'dropped', 0)
+        if dropped:
+            records.insert(0, logging.LogRecord(
+                __name__, logging.WARNING, __file__, 0,
+                "[%s] %d earlier log records were dropped" %
+                (self._local.name, dropped), None, None))
+        self._local.records = None
+        return records
+
+    def filter(self, record):
+        records = getattr(self._local, 'records', None)
+        if records is None:
+            return True
+        # The same record passes through every root handler's filter.
+        if not getattr(record, 'buffered', False):
+            record.msg = "[%s] %s" % (self._local.name, record.getMessage())
+            record.args = None
+            record.buffered = True
+            if len(records) == records.maxlen:
+                self._local.dropped += 1
+            records.append(record)
+        return False
+
+    @staticmethod
+    def flush(records):
+        for record in records:
+            logging.getLogger(record.name).handle(record)
@@ -31,21 +31,32 @@ import ConfigParser
 import jeepyb.utils as u
 
 
-registry = u.ProjectsRegistry()
+_registry = None
+
+
+def get_registry():
+    """Return the registry of projects.yaml, creating it on first use.
+
+    A new registry is created when projects.yaml changes, so long running
+    processes see the current file.
+    """
+    global _registry
+    if _registry is None or _registry.is_stale():
+        _registry = u.ProjectsRegistry()
+    return _registry
 
 
 def project_to_groups(project_full_name):
-    return registry[project_full_name] \
-        .get('groups',
-             [registry[project_full_name].get('group',
-                                              u.short_project_name(
-                                                  project_full_name))])
+    section = get_registry()[project_full_name]
+    return section.get('groups',
+                       [section.get('group',
+                                    u.short_project_name(project_full_name))])
 
 
 def _is_no_launchpad(project_full_name, obj_type):
     try:
         return ('no-launchpad-' + obj_type
-                in registry[project_full_name]['options'])
+                in get_registry()[project_full_name]['options'])
     except KeyError:
         return False
 
@@ -60,6 +71,7 @@ def is_no_launchpad_blueprints(project_full_name):
 
 def has_github(project_full_name):
     try:
+        registry = get_registry()
         if not registry.defaults.get('projects', 'has-github'):
             # If the default is not to use GitHub...
             try:
@@ -77,18 +89,18 @@ def has_github(project_full_name):
 
 def has_translations(project_full_name):
     try:
-        return 'translate' in registry[project_full_name]['options']
+        return 'translate' in get_registry()[project_full_name]['options']
     except KeyError:
         return False
 
 
 def is_delay_release(project_full_name):
     try:
-        return 'delay-release' in registry[project_full_name]['options']
+        return 'delay-release' in get_registry()[project_full_name]['options']
     except KeyError:
         return False
 
 
 def docimpact_target(project_full_name):
-    return registry.get_project_item(project_full_name, 'docimpact-group',
-                                     'unknown')
+    return get_registry().get_project_item(project_full_name,
+                                           'docimpact-group', 'unknown')
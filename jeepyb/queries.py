@@ -0,0 +1,146 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Named queries against the Gerrit database.
+
+Every statement jeepyb runs is declared once in STATEMENTS.  Statements
+with an {keys} placeholder take a list of keys, which is sent in batches
+of up to BATCH_SIZE as a single "IN (...)" query each, so looking up a
+thousand emails costs a couple of queries rather than a thousand.  The
+helpers below return dicts keyed by the keys they were given.
+"""
+
+import threading
+
+import jeepyb.gerritdb
+
+BATCH_SIZE = 500
+
+STATEMENTS = {
+    # Gerrit keeps every address and identity of an account as a separate
+    # row of account_external_ids, for example:
+    # +-----------------+--------------------------------------+
+    # | email_address   | external_id                          |
+    # +-----------------+--------------------------------------+
+    # | plugh@xyzzy.com | https://login.ubuntu.com/+id/fR0bnU1 |
+    # | bar@foo.org     | mailto:bar@foo.org                   |
+    # | NULL            | username:quux                        |
+    # +-----------------+--------------------------------------+
+    # so the Launchpad OpenID for any of the account's addresses takes a
+    # join on the account id.
+    'launchpad_openids': """
+        SELECT original.email_address, t.external_id
+        FROM account_external_ids t
+        INNER JOIN (
+            SELECT account_id, email_address FROM account_external_ids
+            WHERE email_address IN ({keys}) )
+        original ON t.account_id = original.account_id
+        AND t.external_id LIKE 'https://login.ubuntu.com%%'""",
+    'patchset_counts': """
+        SELECT a.email_address, COUNT(DISTINCT p.change_id + p.patch_set_id)
+        FROM patch_sets p, account_external_ids a
+        WHERE a.email_address IN ({keys})
+        AND a.account_id = p.uploader_account_id
+        GROUP BY a.email_address""",
+    'group_uuids': """
+        SELECT name, group_uuid FROM account_groups
+        WHERE name IN ({keys})""",
+    'all_group_uuids': """
+        SELECT name, group_uuid FROM account_groups""",
+    'change_subjects': """
+        SELECT change_key, subject, topic FROM changes
+        WHERE change_key IN ({keys})""",
+}
+
+# Statement text by (name, number of keys), built once
+_prepared = {}
+_prepared_lock = threading.Lock()
+
+
+def _statement(name, key_count=0):
+    with _prepared_lock:
+        statement = _prepared.get((name, key_count))
+        if statement is None:
+            statement = STATEMENTS[name]
+            if key_count:
+                statement = statement.format(
+                    keys=", ".join(["%s"] * key_count))
+            _prepared[(name, key_count)] = statement
+        return statement
+
+
+def query(name, params=()):
+    """Run the named statement and return all of its rows."""
+    with jeepyb.gerritdb.connection() as con:
+        cursor = con.cursor()
+        cursor.execute(_statement(name), tuple(params))
+        rows = cursor.fetchall()
+        cursor.close()
+    return list(rows)
+
+
+def lookup(name, keys, batch_size=BATCH_SIZE):
+    """Run the named statement for keys, batch_size keys at a time.
+
+    Returns the rows of all the batches.
+    """
+    keys = sorted(set(keys))
+    rows = []
+    if not keys:
+        return rows
+    with jeepyb.gerritdb.connection() as con:
+        cursor = con.cursor()
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            cursor.execute(_statement(name, len(batch)), tuple(batch))
+            rows.extend(cursor.fetchall())
+        cursor.close()
+    return rows
+
+
+def _by_email(emails):
+    # The database compares addresses case-insensitively, so the rows may
+    # not spell them the way the caller did
+    return dict((email.lower(), email) for email in emails)
+
+
+def launchpad_openids(emails):
+    """Map each of emails that has a Launchpad OpenID to it."""
+    by_email = _by_email(emails)
+    openids = {}
+    for email, openid in lookup('launchpad_openids', emails):
+        openids.setdefault(by_email.get(email.lower(), email), openid)
+    return openids
+
+
+def patchset_counts(emails):
+    """Map each of emails to the number of patch sets it uploaded."""
+    by_email = _by_email(emails)
+    counts = dict((email, 0) for email in emails)
+    for email, count in lookup('patchset_counts', emails):
+        email = by_email.get(email.lower(), email)
+        counts[email] = counts.get(email, 0) + count
+    return counts
+
+
+def group_uuids(names=None):
+    """Map group names to their UUIDs, for all groups if names is None."""
+    if names is None:
+        return dict(query('all_group_uuids'))
+    return dict(lookup('group_uuids', names))
+
+
+def change_subjects(change_keys):
+    """Map each of change_keys (Change-Ids) to its (subject, topic)."""
+    return dict((change_key, (subject, topic))
+                for change_key, subject, topic
+                in lookup('change_subjects', change_keys))
@@ -0,0 +1,238 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Mirror the branches and tags of an upstream repository into Gerrit.
+
+Every upstream branch X becomes refs/heads/X in Gerrit, or
+refs/heads/<prefix>/X when the project has an upstream-prefix, and every
+tag keeps its name.  The refs Gerrit should have are compared with the
+ones it has (from ls-remote) and only those that differ are pushed, in a
+single atomic push straight from the fetched refs, so the working tree is
+never touched.  Branches are only fast-forwarded and tags that already
+exist are never moved, the same as a plain git push: branches Gerrit has
+moved away from upstream are left out of the push and logged.
+"""
+
+import logging
+import re
+
+import jeepyb.gitrepo as gitrepo
+import jeepyb.utils as u
+
+log = logging.getLogger("jeepyb.upstream")
+
+LS_REMOTE_RE = re.compile(r'^(?P<sha>[0-9a-f]{40})\t(?P<ref>refs/\S+)$')
+UPSTREAM_REFS = 'refs/remotes/upstream/'
+
+
+class SyncError(Exception):
+    pass
+
+
+def ls_remote(url, env=None):
+    """Return a dict of ref name to sha for the branches and tags at url."""
+    status, out = u.run_command_status(
+        "git ls-remote --heads --tags %s" % url, env=env)
+    if status != 0:
+        raise SyncError("git ls-remote %s failed: %s" % (url, out))
+    refs = {}
+    # ssh may add warnings of its own to the output
+    for line in out.splitlines():
+        m = LS_REMOTE_RE.match(line)
+        if m and not m.group('ref').endswith('^{}'):
+            refs[m.group('ref')] = m.group('sha')
+    return refs
+
+
+def gerrit_refs(upstream_refs, upstream_prefix=None):
+    """Map upstream refs (refs/heads/*, refs/tags/*) to Gerrit's names."""
+    wanted = {}
+    for ref, sha in upstream_refs.items():
+        if ref.startswith('refs/heads/'):
+            branch = ref[len('refs/heads/'):]
+            if upstream_prefix:
+                branch = "%s/%s" % (upstream_prefix, branch)
+            wanted['refs/heads/%s' % branch] = sha
+        elif ref.startswith('refs/tags/'):
+            wanted[ref] = sha
+    return wanted
+
+
+def changed_refs(wanted, current, quiet=False):
+    """Return the refs of wanted (name to sha) that current lacks."""
+    changed = {}
+    for ref, sha in wanted.items():
+        have = current.get(ref)
+        if have == sha:
+            continue
+        if have and ref.startswith('refs/tags/'):
+            if not quiet:
+                log.warning("Not moving tag %s from %s to %s" %
+                            (ref, have, sha))
+            continue
+        changed[ref] = sha
+    return changed
+
+
+def is_ancestor(repo_path, ancestor, sha):
+    """Return whether ancestor is an ancestor of sha in repo_path.
+
+    None if that is not known, because one of them is not in repo_path.
+    """
+    status = u.git_command(
+        repo_path, "merge-base --is-ancestor %s %s" % (ancestor, sha))
+    if status in (0, 1):
+        return status == 0
+    return None
+
+
+def diverged_refs(repo_path, refs, current, unknown=True):
+    """Return the branches of refs that cannot fast-forward in current.
+
+    Those are the branches whose tip in current is not an ancestor of the
+    sha in refs.  unknown says what to count branches as when one of the
+    two is not in repo_path.
+    """
+    diverged = {}
+    for ref, sha in refs.items():
+        have = current.get(ref)
+        if not have or not ref.startswith('refs/heads/'):
+            continue
+        ancestor = is_ancestor(repo_path, have, sha)
+        if ancestor is False or (ancestor is None and unknown):
+            diverged[ref] = sha
+    return diverged
+
+
+def fetched_refs(repo_path):
+    """Return the upstream refs fetched into repo_path by upstream name."""
+    with gitrepo.GitRepo(repo_path) as repo:
+        refs = repo.refs('refs/tags/')
+        for ref, sha in repo.refs(UPSTREAM_REFS).items():
+            refs['refs/heads/%s' % ref[len(UPSTREAM_REFS):]] = sha
+    return refs
+
+
+def import_mode(section):
+    """Return the upstream-import mode of a project and its mirror.
+
+    The mirror is the path of the local mirror for the mirror mode, None
+    for the others.
+    """
+    mode = section.get('upstream-import', 'full')
+    if mode not in u.UPSTREAM_IMPORT_MODES:
+        raise SyncError("unknown upstream-import %s for %s" %
+                        (mode, section['project']))
+    mirror = None
+    if mode == 'mirror':
+        mirror = section.get('upstream-mirror')
+        if not mirror:
+            raise SyncError("upstream-import mirror for %s needs an "
+                            "upstream-mirror" % section['project'])
+    return mode, mirror
+
+
+def pushed_refs(repo_path, refspec):
+    """Return the refs (name to sha) pushing refspec should leave behind.
+
+    Tags are included, as they are pushed along with every refspec.
+    """
+    src, dst = refspec.lstrip('+').split(':')
+    with gitrepo.GitRepo(repo_path) as repo:
+        refs = repo.refs('refs/tags/')
+        if src.endswith('*'):
+            for ref, sha in repo.refs(src[:-1]).items():
+                refs[dst[:-1] + ref[len(src) - 1:]] = sha
+        else:
+            refs[dst] = repo.rev_parse(src)
+    return refs
+
+
+def verify_push(remote_url, refs, env=None):
+    """Raise SyncError unless remote_url has all of refs (name to sha)."""
+    missing = changed_refs(refs, ls_remote(remote_url, env), quiet=True)
+    if missing:
+        raise SyncError("%s is missing %d pushed refs: %s" %
+                        (remote_url, len(missing),
+                         ', '.join(sorted(missing))))
+
+
+def pending_refs(repo_path, upstream, remote_url, upstream_prefix=None,
+                 env=None):
+    """Return the refs Gerrit is missing, without fetching anything.
+
+    Both sides are listed with ls-remote, so a project that is up to date
+    costs two ref advertisements.  Branches already known (from repo_path)
+    to have diverged in Gerrit do not count, as they cannot be pushed.
+    """
+    current = ls_remote(remote_url, env)
+    pending = changed_refs(gerrit_refs(ls_remote(upstream, env),
+                                       upstream_prefix),
+                           current, quiet=True)
+    for ref in diverged_refs(repo_path, pending, current, unknown=False):
+        del pending[ref]
+    return pending
+
+
+def push_refs(repo_path, remote, refs, env=None):
+    """Push refs (name to sha) to remote in one atomic push.
+
+    If the atomic push is refused, each ref is pushed on its own so one
+    bad ref does not hold back the others.  Returns the refs that could
+    not be pushed.
+    """
+    refspecs = ' '.join('%s:%s' % (sha, ref)
+                        for ref, sha in sorted(refs.items()))
+    status, out = u.git_command_output(
+        repo_path, "push --atomic --porcelain %s %s" % (remote, refspecs),
+        env=env)
+    if status == 0:
+        return {}
+    log.warning("Atomic push to %s failed, pushing refs one by one: %s" %
+                (remote, out))
+    failed = {}
+    for ref, sha in sorted(refs.items()):
+        status, out = u.git_command_output(
+            repo_path, "push --porcelain %s %s:%s" % (remote, sha, ref),
+            env=env)
+        if status != 0:
+            log.error("Push of %s to %s failed: %s" % (ref, remote, out))
+            failed[ref] = sha
+    return failed
+
+
+def sync_upstream(repo_path, project, remote_url, ssh_env, upstream_prefix):
+    """Push the fetched upstream refs of repo_path that Gerrit lacks.
+
+    Use pending_refs() first to skip projects without fetching them.
+    Returns the refs pushed.
+    """
+    current = ls_remote(remote_url, ssh_env)
+    changed = changed_refs(
+        gerrit_refs(fetched_refs(repo_path), upstream_prefix), current)
+    for ref, sha in sorted(
+            diverged_refs(repo_path, changed, current).items()):
+        log.warning("Not pushing %s of %s, %s in Gerrit is not an ancestor "
+                    "of %s" % (ref, project, current[ref], sha))
+        del changed[ref]
+    if not changed:
+        log.info("%s is up to date with upstream" % project)
+        return changed
+    log.info("Pushing %d refs of %s to Gerrit" % (len(changed), project))
+    failed = push_refs(repo_path, remote_url, changed, ssh_env)
+    for ref in failed:
+        del changed[ref]
+    verify_push(remote_url, changed, ssh_env)
+    if failed:
+        raise SyncError("%d refs of %s could not be pushed: %s" %
+                        (len(failed), project, ', '.join(sorted(failed))))
+    return changed
@@ -12,80 +12,407 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
 import ConfigParser
+import errno
+import hashlib
+import json
 import logging
 import os
+import random
 import shlex
+import shutil
+import signal
 import subprocess
 import tempfile
-import yaml
+import threading
+import time
 
 PROJECTS_INI = os.environ.get('PROJECTS_INI', '/home/gerrit2/projects.ini')
 PROJECTS_YAML = os.environ.get('PROJECTS_YAML', '/home/gerrit2/projects.yaml')
 
 log = logging.getLogger("jeepyb.utils")
 
+_launchpad_logins = threading.local()
+
+# What C git fsck only warns about is accepted, except zeroPaddedFilemode,
+# which Gerrit (jgit) refuses, so the import copies reject that as well,
+# both in fetches and in fsck.  Checking objects as they are fetched turns
+# all warnings into errors, so the other warnings are kept as warnings.
+FSCK_WARNINGS = ('emptyName', 'fullPathname', 'hasDot', 'hasDotdot',
+                 'hasDotgit', 'nullSha1', 'nulInCommit')
+FSCK_CONFIG = (
+    ('fetch.fsckObjects', 'true'),
+    ('transfer.fsckObjects', 'true'),
+    ('fsck.zeroPaddedFilemode', 'error'),
+    ('fetch.fsck.zeroPaddedFilemode', 'error'),
+) + tuple(('fetch.fsck.%s' % msg_id, 'warn') for msg_id in FSCK_WARNINGS)
+FULL_FSCK_INTERVAL = 7 * 24 * 60 * 60
+
+# How track-upstream's local copy of a project gets its objects:
+# everything, everything but the blobs (fetched later where needed), or
+# with an existing local mirror of upstream as reference.  The first
+# import by manage-projects pushes everything to Gerrit, so it treats
+# partial like full.
+UPSTREAM_IMPORT_MODES = ('full', 'partial', 'mirror')
+
 
 def short_project_name(full_project_name):
     """Return the project part of the git repository name."""
     return full_project_name.split('/')[-1]
 
 
-def run_command(cmd, status=False, env=None):
-    env = env or {}
-    cmd_list = shlex.split(str(cmd))
-    newenv = os.environ
-    newenv.update(env)
-    log.info("Executing command: %s" % " ".join(cmd_list))
-    p = subprocess.Popen(cmd_list, stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT, env=newenv)
-    (out, nothing) = p.communicate()
-    log.debug("Return code: %s" % p.returncode)
-    log.debug("Command said: %s" % out.strip())
+class Command(object):
+    """A running command with its combined stdout and stderr.
+
+    Iterating over a Command yields its output line by line as it is
+    produced; only the last tail_lines lines are kept (in tail) for error
+    reports.  The command is killed once timeout seconds have passed, or
+    when cancel() is called, along with anything it started (like the ssh
+    of a git fetch), which would otherwise keep its output open.  If input
+    is given, it is written to the standard input of the command.
+    """
+
+    def __init__(self, cmd, env=None, timeout=None, tail_lines=100,
+                 input=None):
+        cmd_list = shlex.split(str(cmd))
+        newenv = os.environ.copy()
+        newenv.update(env or {})
+        log.info("Executing command: %s" % " ".join(cmd_list))
+        stdin = None
+        if input is not None:
+            stdin = subprocess.PIPE
+        # The command gets a process group of its own so that cancel() can
+        # kill everything it started.  That also keeps a Ctrl-C on the
+        # terminal from reaching it, so __iter__() and wait() pass a
+        # KeyboardInterrupt on with cancel().  Should jeepyb itself be
+        # killed the command is left to finish on its own, which is fine
+        # for the git commands run here.
+        self.process = subprocess.Popen(cmd_list, stdin=stdin,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, env=newenv,
+                                        universal_newlines=True,
+                                        preexec_fn=os.setsid)
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.returncode = None
+        self.timed_out = False
+        self._timer = None
+        if timeout:
+            self._timer = threading.Timer(timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+        if input is not None:
+            # Written while the output is read, so neither side can block
+            # the other once a pipe is full
+            writer = threading.Thread(target=self._write, args=(input,))
+            writer.daemon = True
+            writer.start()
+
+    def _write(self, input):
+        try:
+            self.process.stdin.write(input)
+            self.process.stdin.close()
+        except (IOError, OSError, ValueError):
+            # The command exited early, its output says why
+            pass
+
+    def _expire(self):
+        self.timed_out = True
+        log.error("Command timed out, killing pid %s" % self.process.pid)
+        self.cancel()
+
+    def cancel(self):
+        if self.process.returncode is not None:
+            # Reaped already, its pid may belong to someone else by now
+            return
+        try:
+            # The command leads its own process group
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            # Already gone
+            pass
+
+    def __iter__(self):
+        try:
+            for line in iter(self.process.stdout.readline, ''):
+                line = line.rstrip('\n')
+                self.tail.append(line)
+                log.debug("Command said: %s" % line)
+                yield line
+        except KeyboardInterrupt:
+            self.cancel()
+            raise
+        self.wait()
+
+    def wait(self):
+        """Wait for the command to finish and return its exit status."""
+        if self.returncode is None:
+            try:
+                # Drain whatever output is left so the command cannot
+                # block on a full pipe.
+                for line in iter(self.process.stdout.readline, ''):
+                    self.tail.append(line.rstrip('\n'))
+                self.returncode = self.process.wait()
+            except KeyboardInterrupt:
+                self.cancel()
+                raise
+            if self._timer:
+                self._timer.cancel()
+            log.debug("Return code: %s" % self.returncode)
+        return self.returncode
+
+
+def run_command(cmd, status=False, env=None, timeout=None, input=None):
+    command = Command(cmd, env=env, timeout=timeout, input=input)
+    out = "\n".join(command).strip()
     if status:
-        return (p.returncode, out.strip())
-    return out.strip()
+        return (command.wait(), out)
+    return out
 
 
-def run_command_status(cmd, env=None):
+def run_command_status(cmd, env=None, timeout=None):
     env = env or {}
-    return run_command(cmd, True, env)
+    return run_command(cmd, True, env, timeout)
 
 
-def git_command(repo_dir, sub_cmd, env=None):
-    env = env or {}
+def command_status(cmd, env=None, timeout=None, input=None):
+    """Run cmd and return its exit status.
+
+    Unlike run_command_status() the output is not collected, only the
+    last lines of it are kept while it is read.
+    """
+    command = Command(cmd, env=env, timeout=timeout, input=input)
+    for _ in command:
+        pass
+    return command.wait()
+
+
+def _git_cmd(repo_dir, sub_cmd):
     git_dir = os.path.join(repo_dir, '.git')
-    cmd = "git --git-dir=%s --work-tree=%s %s" % (git_dir, repo_dir, sub_cmd)
-    status, _ = run_command(cmd, True, env)
-    return status
+    if not os.path.isdir(git_dir) and os.path.isfile(
+            os.path.join(repo_dir, 'HEAD')):
+        # A bare repository
+        return "git --git-dir=%s %s" % (repo_dir, sub_cmd)
+    return "git --git-dir=%s --work-tree=%s %s" % (git_dir, repo_dir, sub_cmd)
 
 
-def git_command_output(repo_dir, sub_cmd, env=None):
+def git_command(repo_dir, sub_cmd, env=None, timeout=None, input=None):
     env = env or {}
-    git_dir = os.path.join(repo_dir, '.git')
-    cmd = "git --git-dir=%s --work-tree=%s %s" % (git_dir, repo_dir, sub_cmd)
-    status, out = run_command(cmd, True, env)
+    return command_status(_git_cmd(repo_dir, sub_cmd), env, timeout, input)
+
+
+def git_command_output(repo_dir, sub_cmd, env=None, timeout=None):
+    env = env or {}
+    status, out = run_command(_git_cmd(repo_dir, sub_cmd), True, env, timeout)
     return (status, out)
 
 
-def make_ssh_wrapper(gerrit_user, gerrit_key):
+def git_command_stream(repo_dir, sub_cmd, env=None, timeout=None):
+    """Start a git command and return it as a Command to stream from."""
+    return Command(_git_cmd(repo_dir, sub_cmd), env=env, timeout=timeout)
+
+
+def backoff(timeout, initial=0.1, maximum=5, event=None):
+    """Yield until timeout seconds have passed, pausing between iterations.
+
+    The first iteration happens straight away, after that the pauses grow
+    exponentially from initial up to maximum seconds, with jitter so that
+    concurrent callers do not poll in lockstep.  If a threading.Event is
+    given, setting it cuts the current pause short.
+    """
+    deadline = time.time() + timeout
+    delay = initial
+    while True:
+        yield
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        pause = min(random.uniform(delay / 2, delay * 1.5), remaining)
+        if event is None:
+            time.sleep(pause)
+        elif event.wait(pause):
+            event.clear()
+        delay = min(delay * 2, maximum)
+
+
+def wait_for_ref(remote_url, ref, env=None, timeout=60, event=None):
+    """Wait for ref to exist on remote_url.
+
+    Returns the number of seconds waited, or None if the ref did not show
+    up within timeout seconds.
+    """
+    start = time.time()
+    for _ in backoff(timeout, event=event):
+        status, out = run_command_status(
+            "git ls-remote %s %s" % (remote_url, ref), env=env)
+        if status == 0 and out:
+            return time.time() - start
+    return None
+
+
+def seconds_since(repo_path, key):
+    """Return the seconds since the time in repo_path's key setting.
+
+    None if the setting is missing.
+    """
+    status, value = git_command_output(repo_path, "config --get %s" % key)
+    if status != 0 or not value.isdigit():
+        return None
+    return time.time() - int(value)
+
+
+def record_time(repo_path, key):
+    """Set repo_path's key setting to the current time."""
+    git_command(repo_path, "config %s %d" % (key, time.time()))
+
+
+def fsck_repo(repo_path, full_interval=FULL_FSCK_INTERVAL):
+    """Make sure repo_path holds nothing Gerrit would refuse.
+
+    The first time, and again once full_interval seconds have passed, the
+    whole repository is checked with git fsck --full.  That also turns on
+    fetch.fsckObjects, so in between every fetch checks the objects it
+    brings in and refuses the ones fsck would.  The time of the last full
+    check is kept in the repository's jeepyb.lastfullfsck setting.
+    """
+    since = seconds_since(repo_path, 'jeepyb.lastfullfsck')
+    if since is not None and since < full_interval:
+        log.debug("Objects of %s were checked as they were fetched" %
+                  repo_path)
+        return
+
+    for key, value in FSCK_CONFIG:
+        git_command(repo_path, "config %s %s" % (key, value))
+    fsck = git_command_stream(repo_path, 'fsck --full')
+    # Check for non zero return code or warnings which should
+    # be treated as errors. In this case zeroPaddedFilemodes
+    # will not be accepted by Gerrit/jgit but are accepted by C git.
+    bad_filemode = False
+    for line in fsck:
+        if 'zeroPaddedFilemode' in line:
+            bad_filemode = True
+    if fsck.wait() != 0 or bad_filemode:
+        log.error('git fsck of %s failed:\n%s' %
+                  (repo_path, '\n'.join(fsck.tail)))
+        raise Exception('git fsck failed not importing')
+    record_time(repo_path, 'jeepyb.lastfullfsck')
+
+
+def count_objects(repo_path):
+    """Return the numbers from git count-objects -v (sizes in KiB)."""
+    status, out = git_command_output(repo_path, "count-objects -v")
+    counts = {}
+    if status != 0:
+        return counts
+    for line in out.splitlines():
+        key, _, value = line.partition(':')
+        if value.strip().isdigit():
+            counts[key.strip()] = int(value)
+    return counts
+
+
+def describe_objects(repo_path):
+    counts = count_objects(repo_path)
+    return "%d objects, %.1f MiB in %d packs" % (
+        counts.get('count', 0) + counts.get('in-pack', 0),
+        (counts.get('size', 0) + counts.get('size-pack', 0)) / 1024.0,
+        counts.get('packs', 0))
+
+
+def ensure_dir(path):
+    """Create path and its parents unless they exist.
+
+    Safe to call from several threads for the same path at once.
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def make_ssh_wrapper(gerrit_user, gerrit_key, control_dir=None,
+                     control_persist=600):
+    """Write a GIT_SSH wrapper and return the environment that uses it.
+
+    If control_dir is given, the wrapper shares one master connection per
+    remote host (ssh ControlMaster) through a socket in a private directory
+    below control_dir, so that repeated git operations against the same
+    Gerrit skip the ssh handshake. Use cleanup_ssh_wrapper() to close the
+    master connections and remove the wrapper again.
+    """
+    ssh_opts = '-o "StrictHostKeyChecking no"'
+    env = {}
+    if control_dir:
+        ensure_dir(control_dir)
+        socket_dir = tempfile.mkdtemp(prefix='ssh-', dir=control_dir)
+        ssh_opts += (' -o ControlMaster=auto -o ControlPath=%s/%%C'
+                     ' -o ControlPersist=%s' % (socket_dir, control_persist))
+        env['JEEPYB_SSH_CONTROL_DIR'] = socket_dir
     (fd, name) = tempfile.mkstemp(text=True)
     os.write(fd, '#!/bin/bash\n')
     os.write(fd,
-             'ssh -i %s -l %s -o "StrictHostKeyChecking no" $@\n' %
-             (gerrit_key, gerrit_user))
+             'ssh -i %s -l %s %s $@\n' %
+             (gerrit_key, gerrit_user, ssh_opts))
     os.close(fd)
     os.chmod(name, 0o755)
-    return dict(GIT_SSH=name)
+    env['GIT_SSH'] = name
+    return env
+
+
+def cleanup_ssh_wrapper(ssh_env):
+    """Stop any master connections and remove the GIT_SSH wrapper."""
+    socket_dir = ssh_env.get('JEEPYB_SSH_CONTROL_DIR')
+    if socket_dir and os.path.isdir(socket_dir):
+        for name in os.listdir(socket_dir):
+            run_command("ssh -o ControlPath=%s -O exit jeepyb" %
+                        os.path.join(socket_dir, name))
+        shutil.rmtree(socket_dir, ignore_errors=True)
+    os.unlink(ssh_env['GIT_SSH'])
+
+
+def update_object_cache(cache_path, name, url, env=None):
+    """Fetch url into the bare repository used as an object cache.
+
+    The cache is kept across runs.  The refs of each source are kept under
+    refs/cache/<name>/ so that the objects stay reachable and later
+    fetches only transfer what changed.
+    Returns the cache path, or None if it could not be brought up to date.
+    """
+    env = env or {}
+    if not os.path.exists(cache_path):
+        status, out = run_command_status(
+            "git init --bare %s" % cache_path)
+        if status != 0:
+            log.error("Failed to create object cache %s: %s" %
+                      (cache_path, out))
+            return None
+    status, out = run_command_status(
+        "git --git-dir=%s fetch --prune --no-tags %s "
+        "+refs/heads/*:refs/cache/%s/heads/* "
+        "+refs/tags/*:refs/cache/%s/tags/*" % (cache_path, url, name, name),
+        env=env)
+    if status != 0:
+        log.error("Failed to update object cache %s from %s: %s" %
+                  (cache_path, url, out))
+        return None
+    return cache_path
 
 
 def make_local_copy(repo_path, project, project_list,
                     git_opts, ssh_env, upstream, GERRIT_HOST, GERRIT_PORT,
-                    project_git, GERRIT_GITID):
+                    project_git, GERRIT_GITID, reference=None):
 
     # Ensure that the base location exists
-    if not os.path.exists(os.path.dirname(repo_path)):
-        os.makedirs(os.path.dirname(repo_path))
+    ensure_dir(os.path.dirname(repo_path))
+
+    # The local copy is only pushed from and removed again, so it is not
+    # checked out.  Objects are borrowed from a local object cache if we
+    # have one (through alternates, so they are neither transferred nor
+    # copied), which has to stay around for as long as the copy does.
+    clone_opts = "--no-checkout "
+    if reference:
+        clone_opts += "--reference %s " % reference
 
     # Three choices
     #  - If gerrit has it, get from gerrit
@@ -99,13 +426,15 @@ def make_local_copy(repo_path, project, project_list,
     #                'gerrit repo has a master branch'
     if project in project_list:
         try:
-            run_command(
-                "git clone %(remote_url)s %(repo_path)s" % git_opts,
+            command_status(
+                "git clone %s%s %s" % (
+                    clone_opts, git_opts['remote_url'], repo_path),
                 env=ssh_env)
             if upstream:
                 git_command(
                     repo_path,
-                    "remote add -f upstream %(upstream)s" % git_opts)
+                    "remote add -f upstream %(upstream)s" % git_opts,
+                    env=ssh_env)
             return None
         except Exception:
             # If the clone fails, then we need to clone from the upstream
@@ -119,8 +448,8 @@ def make_local_copy(repo_path, project, project_list,
     # purposes, so rename origin to upstream and add a new
     # origin remote that points at gerrit
     if upstream:
-        run_command(
-            "git clone %(upstream)s %(repo_path)s" % git_opts,
+        command_status(
+            "git clone %s%s %s" % (clone_opts, upstream, repo_path),
             env=ssh_env)
         git_command(
             repo_path,
@@ -135,7 +464,7 @@ def make_local_copy(repo_path, project, project_list,
     # Neither gerrit has it, nor does it have an upstream,
     # just create a whole new one
     else:
-        run_command("git init %s" % repo_path)
+        command_status("git init %s" % repo_path)
         git_command(
             repo_path,
             "remote add origin %(remote_url)s" % git_opts)
@@ -154,39 +483,317 @@ project=%s
         return "push %s HEAD:refs/heads/master"
 
 
+def launchpad_login(cache_dir, credentials_file):
+    """Log in to Launchpad, reusing this thread's earlier login.
+
+    launchpadlib connections must not be shared between threads, so each
+    thread that calls this keeps its own.
+    """
+    logins = _launchpad_logins.__dict__.setdefault('logins', {})
+    key = (cache_dir, credentials_file)
+    if key not in logins:
+        # launchpadlib is slow to import, so only pay for it when needed
+        from launchpadlib import launchpad
+        from launchpadlib import uris
+        logins[key] = launchpad.Launchpad.login_with(
+            'Gerrit User Sync', uris.LPNET_SERVICE_ROOT, cache_dir,
+            credentials_file=credentials_file, version='devel')
+    return logins[key]
+
+
+def yaml_loader():
+    """Return the yaml loader class to parse projects.yaml and configs with.
+
+    yaml is imported here rather than at the top of the module: it is most
+    of the import time of jeepyb.utils, and hooks read projects.yaml from
+    the JSON registry snapshot, so they usually do without it.
+    """
+    import yaml
+    # libyaml is several times faster than the pure Python loader
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def _compose_node(loader, event, anchors):
+    """Build the node that starts with event from the loader's events."""
+    import yaml
+    if isinstance(event, yaml.AliasEvent):
+        return anchors[event.anchor]
+
+    tag = event.tag
+    if isinstance(event, yaml.ScalarEvent):
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+        node = yaml.ScalarNode(tag, event.value, event.start_mark,
+                               event.end_mark, style=event.style)
+    elif isinstance(event, yaml.SequenceStartEvent):
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.SequenceNode, None, event.implicit)
+        node = yaml.SequenceNode(tag, [], event.start_mark, None,
+                                 flow_style=event.flow_style)
+    else:
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.MappingNode, None, event.implicit)
+        node = yaml.MappingNode(tag, [], event.start_mark, None,
+                                flow_style=event.flow_style)
+    if event.anchor is not None:
+        anchors[event.anchor] = node
+
+    if isinstance(node, yaml.SequenceNode):
+        while not loader.check_event(yaml.SequenceEndEvent):
+            node.value.append(
+                _compose_node(loader, loader.get_event(), anchors))
+        node.end_mark = loader.get_event().end_mark
+    elif isinstance(node, yaml.MappingNode):
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _compose_node(loader, loader.get_event(), anchors)
+            value = _compose_node(loader, loader.get_event(), anchors)
+            node.value.append((key, value))
+        node.end_mark = loader.get_event().end_mark
+    return node
+
+
+def _skip_node(loader):
+    import yaml
+    depth = 0
+    while True:
+        event = loader.get_event()
+        if isinstance(event, (yaml.SequenceStartEvent,
+                              yaml.MappingStartEvent)):
+            depth += 1
+        elif isinstance(event, (yaml.SequenceEndEvent,
+                                yaml.MappingEndEvent)):
+            depth -= 1
+        if depth == 0:
+            return
+
+
+def iter_projects(yaml_file=PROJECTS_YAML, keys=None, single_doc=True,
+                  loader_class=None):
+    """Iterate over the project entries of a projects.yaml file.
+
+    Unlike ProjectsRegistry this never builds the whole document: the
+    file is parsed event by event and only one project entry is
+    constructed at a time.  If keys is given, each entry is reduced to
+    those keys.  single_doc selects the same document ProjectsRegistry
+    would use.
+    """
+    import yaml
+    if loader_class is None:
+        loader_class = yaml_loader()
+    doc_index = 0 if single_doc else 1
+
+    with open(yaml_file, 'rb') as yaml_in:
+        loader = loader_class(yaml_in)
+        try:
+            loader.get_event()  # StreamStartEvent
+            for i in range(doc_index):
+                if loader.check_event(yaml.StreamEndEvent):
+                    return
+                loader.get_event()  # DocumentStartEvent
+                _skip_node(loader)
+                loader.get_event()  # DocumentEndEvent
+            if loader.check_event(yaml.StreamEndEvent):
+                return
+            loader.get_event()  # DocumentStartEvent
+            if not loader.check_event(yaml.SequenceStartEvent):
+                return
+            loader.get_event()
+
+            anchors = {}
+            while not loader.check_event(yaml.SequenceEndEvent):
+                node = _compose_node(loader, loader.get_event(), anchors)
+                entry = loader.construct_document(node)
+                if keys is not None:
+                    entry = dict((key, entry[key]) for key in keys
+                                 if key in entry)
+                yield entry
+        finally:
+            loader.dispose()
+
+
 class ProjectsRegistry(object):
     """read config from ini or yaml file.
 
     It could be used as dict 'project name' -> 'project properties'.
+
+    The yaml file is only parsed the first time anything is looked up.
+    Parsing projects.yaml is slow, so the result is kept in a JSON
+    snapshot next to it (snapshot_file) together with indexes by option
+    and by org; the snapshot is used for as long as the yaml file has the
+    same mtime and size, or failing that the same sha256.  Files with
+    values JSON cannot hold as they are (like dates) get no snapshot.
     """
-    def __init__(self, yaml_file=PROJECTS_YAML, single_doc=True):
-        self.yaml_doc = [c for c in yaml.safe_load_all(open(yaml_file))]
+    SNAPSHOT_VERSION = 2
+
+    def __init__(self, yaml_file=PROJECTS_YAML, single_doc=True,
+                 snapshot_file=None):
+        self.yaml_file = yaml_file
         self.single_doc = single_doc
+        if snapshot_file is None:
+            snapshot_file = '%s.snapshot' % yaml_file
+        self.snapshot_file = snapshot_file
+        self._loaded = False
+        self._lock = threading.Lock()
 
-        self.configs_list = []
-        self.defaults = {}
-        self._parse_file()
+    def _read_snapshot(self):
+        try:
+            with open(self.snapshot_file, 'r') as snapshot_in:
+                snapshot = json.loads(snapshot_in.read())
+        except (IOError, OSError, ValueError):
+            return None
+        if snapshot.get('version') != self.SNAPSHOT_VERSION:
+            return None
+        return snapshot
+
+    def _write_snapshot(self, snapshot):
+        tmp_file = '%s.%s.tmp' % (self.snapshot_file, os.getpid())
+        try:
+            with open(tmp_file, 'w') as snapshot_out:
+                snapshot_out.write(json.dumps(snapshot))
+            os.rename(tmp_file, self.snapshot_file)
+        except (IOError, OSError) as e:
+            log.debug("Could not write registry snapshot %s: %s" %
+                      (self.snapshot_file, e))
+
+    @staticmethod
+    def _build_indexes(documents):
+        indexes = []
+        for doc in documents:
+            by_option = {}
+            by_org = {}
+            if isinstance(doc, list):
+                for section in doc:
+                    if not isinstance(section, dict) or \
+                            'project' not in section:
+                        continue
+                    project = section['project']
+                    for option in section.get('options', None) or []:
+                        by_option.setdefault(option, []).append(project)
+                    if '/' in project:
+                        org = project.split('/', 1)[0]
+                        by_org.setdefault(org, []).append(project)
+            indexes.append({'option': by_option, 'org': by_org})
+        return indexes
+
+    @staticmethod
+    def _round_trips(documents):
+        try:
+            return json.loads(json.dumps(documents)) == documents
+        except (TypeError, ValueError):
+            return False
+
+    def _load_snapshot(self, st):
+        snapshot = self._read_snapshot()
+        if snapshot:
+            source = snapshot['source']
+            if (source['mtime'], source['size']) == (st.st_mtime, st.st_size):
+                return snapshot
+
+        # The timestamps changed; only reparse if the content did too
+        with open(self.yaml_file, 'rb') as yaml_in:
+            content = yaml_in.read()
+        sha256 = hashlib.sha256(content).hexdigest()
+        if not snapshot or snapshot['source']['sha256'] != sha256:
+            import yaml
+            documents = [c for c in yaml.load_all(
+                content, Loader=yaml_loader())]
+            snapshot = dict(version=self.SNAPSHOT_VERSION,
+                            documents=documents,
+                            indexes=self._build_indexes(documents))
+            if not self._round_trips(documents):
+                # Dates and the like would come back from the snapshot
+                # as something else, so keep parsing the yaml file
+                log.debug("Not writing a registry snapshot of %s, it holds "
+                          "values JSON cannot" % self.yaml_file)
+                return snapshot
+        snapshot['source'] = dict(mtime=st.st_mtime, size=st.st_size,
+                                  sha256=sha256)
+        self._write_snapshot(snapshot)
+        return snapshot
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            st = os.stat(self.yaml_file)
+            self._source = (st.st_mtime, st.st_size)
+            if self.snapshot_file:
+                snapshot = self._load_snapshot(st)
+            else:
+                import yaml
+                with open(self.yaml_file, 'rb') as yaml_in:
+                    documents = [c for c in yaml.load_all(
+                        yaml_in, Loader=yaml_loader())]
+                snapshot = dict(documents=documents,
+                                indexes=self._build_indexes(documents))
+            self._yaml_doc = snapshot['documents']
+            self._indexes = snapshot['indexes']
+            self._parse_file()
+            self._loaded = True
+
+    def is_stale(self):
+        """Whether the yaml file changed since it was loaded."""
+        if not self._loaded:
+            return False
+        try:
+            st = os.stat(self.yaml_file)
+        except OSError:
+            return False
+        return (st.st_mtime, st.st_size) != self._source
+
+    @property
+    def yaml_doc(self):
+        self._load()
+        return self._yaml_doc
+
+    @property
+    def configs_list(self):
+        self._load()
+        return self._configs_list
+
+    @property
+    def configs(self):
+        self._load()
+        return self._configs
+
+    @property
+    def defaults(self):
+        self._load()
+        return self._defaults
 
     def _parse_file(self):
         if self.single_doc:
-            self.configs_list = self.yaml_doc[0]
+            doc_index = 0
         else:
-            self.configs_list = self.yaml_doc[1]
+            doc_index = 1
+        self._configs_list = self._yaml_doc[doc_index]
+        self._index = self._indexes[doc_index]
 
+        self._defaults = {}
         if os.path.exists(PROJECTS_INI):
-            self.defaults = ConfigParser.ConfigParser()
-            self.defaults.read(PROJECTS_INI)
+            self._defaults = ConfigParser.ConfigParser()
+            self._defaults.read(PROJECTS_INI)
         else:
             try:
-                self.defaults = self.yaml_doc[0][0]
+                self._defaults = self._yaml_doc[0][0]
             except IndexError:
                 pass
 
         configs = {}
-        for section in self.configs_list:
+        for section in self._configs_list:
             configs[section['project']] = section
 
-        self.configs = configs
+        self._configs = configs
+
+    def projects_with_option(self, option):
+        """Names of the projects that have option set, in file order."""
+        self._load()
+        return list(self._index['option'].get(option, []))
+
+    def projects_in_org(self, org):
+        """Names of the projects in org, in file order."""
+        self._load()
+        return list(self._index['org'].get(org, []))
 
     def __getitem__(self, item):
         return self.configs[item]
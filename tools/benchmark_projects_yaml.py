@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# Compare the time and peak memory it takes to read a projects.yaml file
+# with the different loaders jeepyb can use.  Every mode runs in its own
+# process so the peak RSS of one does not hide another's.
+#
+#   tools/benchmark_projects_yaml.py /home/gerrit2/projects.yaml
+#   tools/benchmark_projects_yaml.py --generate 20000
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+import jeepyb.utils as u
+
+MODES = ('full-python', 'full-libyaml', 'stream-python', 'stream-libyaml',
+         'snapshot')
+
+
+def generate(count):
+    fd, path = tempfile.mkstemp(prefix='projects-', suffix='.yaml')
+    with os.fdopen(fd, 'w') as out:
+        for i in range(count):
+            out.write("- project: org%d/project-%d\n"
+                      "  description: Benchmark project %d\n"
+                      "  upstream: git://git.example.org/project-%d\n"
+                      "  acl-config: /home/gerrit2/acls/project-%d.config\n"
+                      "  options:\n"
+                      "    - track-upstream\n"
+                      "    - translate\n" % (i % 50, i, i, i, i))
+    return path
+
+
+def run_mode(mode, yaml_file):
+    if mode.endswith('-libyaml'):
+        if not hasattr(yaml, 'CSafeLoader'):
+            return None
+        loader = yaml.CSafeLoader
+    else:
+        loader = yaml.SafeLoader
+
+    start = time.time()
+    if mode.startswith('full-'):
+        with open(yaml_file, 'rb') as yaml_in:
+            projects = [entry['project'] for entry in
+                        list(yaml.load_all(yaml_in, Loader=loader))[0]]
+    elif mode.startswith('stream-'):
+        projects = [entry['project'] for entry in
+                    u.iter_projects(yaml_file, keys=('project',),
+                                    loader_class=loader)]
+    else:
+        registry = u.ProjectsRegistry(yaml_file)
+        projects = [entry['project'] for entry in registry.configs_list]
+    elapsed = time.time() - start
+
+    return dict(mode=mode, projects=len(projects), seconds=elapsed,
+                maxrss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the projects.yaml loaders.')
+    parser.add_argument('yaml_file', nargs='?', help='projects.yaml to read')
+    parser.add_argument('--generate', type=int, metavar='COUNT',
+                        help='benchmark a generated file of COUNT projects')
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_mode(args.child, args.yaml_file)))
+        return
+
+    if args.generate:
+        yaml_file = generate(args.generate)
+    elif args.yaml_file:
+        yaml_file = args.yaml_file
+    else:
+        parser.error('a projects.yaml file or --generate is required')
+
+    def child(mode):
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__),
+             '--child', mode, yaml_file])
+        return json.loads(output)
+
+    try:
+        # Write the snapshot first so the snapshot mode measures a reuse.
+        # This is done in a child as well: the peak RSS of this process
+        # would otherwise be inherited by every child it starts.
+        child('snapshot')
+
+        print("%-16s %10s %10s %12s" % ('mode', 'projects', 'seconds',
+                                        'maxrss (KiB)'))
+        for mode in MODES:
+            result = child(mode)
+            if result is None:
+                print("%-16s %10s" % (mode, 'n/a'))
+                continue
+            print("%(mode)-16s %(projects)10d %(seconds)10.3f "
+                  "%(maxrss)12d" % result)
+    finally:
+        if args.generate:
+            os.unlink(yaml_file)
+            snapshot = '%s.snapshot' % yaml_file
+            if os.path.exists(snapshot):
+                os.unlink(snapshot)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#! /usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# Measure how long it takes to import the module behind each console
+# script in setup.cfg and fail if any of them is over its budget.  Gerrit
+# runs the hooks once per event, so their import time is paid on every
+# upload, comment and merge.
+#
+# Each module is imported in a fresh interpreter, which times the import
+# itself (not the interpreter's own start up).  Point --python at the
+# Python 2 interpreter jeepyb runs under, with its requirements installed.
+#
+#   tools/check_import_time.py --python /usr/bin/python2 --runs 5
+#
+# or tox -e importtime.  The timings depend on the machine and its load, so
+# it is not part of the default tox run and the budgets are well above the
+# numbers below.
+#
+# Measured on Python 2.7.18 (best of 10 runs, in ms), with the registries
+# and configs already created lazily, before yaml and paramiko were
+# imported only where they are used and after:
+#
+#   notify-impact     166.1   59.3
+#   trivial-rebase     15.7   19.4
+#   update-blueprint  120.5   36.1
+#   update-bug        116.2   38.0
+#   welcome-message   129.8   15.3
+#
+# Hooks read projects.yaml through the JSON registry snapshot, so they
+# only import yaml when the snapshot has to be rebuilt.
+
+import argparse
+import ConfigParser
+import os
+import subprocess
+import sys
+
+# Budgets, in milliseconds, for the cumulative import time of a console
+# script's module.  Scripts run from Gerrit hooks get a tighter budget,
+# which still leaves room for a slower or busier machine.
+HOOK_BUDGET = 250
+DEFAULT_BUDGET = 1000
+BUDGETS = {
+    'notify-impact': HOOK_BUDGET,
+    'trivial-rebase': HOOK_BUDGET,
+    'update-blueprint': HOOK_BUDGET,
+    'update-bug': HOOK_BUDGET,
+    'welcome-message': HOOK_BUDGET,
+}
+
+
+def console_scripts(setup_cfg):
+    config = ConfigParser.ConfigParser()
+    config.read(setup_cfg)
+    scripts = []
+    for line in config.get('entry_points', 'console_scripts').splitlines():
+        if '=' not in line:
+            continue
+        name, target = [part.strip() for part in line.split('=', 1)]
+        scripts.append((name, target.split(':')[0]))
+    return scripts
+
+
+TIMER = """
+import time
+start = time.time()
+import %s
+print(time.time() - start)
+"""
+
+
+class MissingModule(Exception):
+    pass
+
+
+def import_time(python, module):
+    """Return how long a fresh interpreter takes to import module, in ms."""
+    proc = subprocess.Popen(
+        [python, '-c', TIMER % module],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        error = err.strip().splitlines()[-1]
+        if error == 'ImportError: No module named %s' % module.split('.')[-1]:
+            raise MissingModule(error)
+        raise RuntimeError(error)
+    return float(out.strip().splitlines()[-1]) * 1000
+
+
+def main():
+    top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(
+        description='Check console script import times against a budget.')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter to measure with')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='take the best of this many runs')
+    parser.add_argument('--setup-cfg',
+                        default=os.path.join(top_dir, 'setup.cfg'))
+    parser.add_argument('scripts', nargs='*',
+                        help='only check these console scripts')
+    args = parser.parse_args()
+
+    failed = False
+    print("%-26s %10s %10s" % ('script', 'ms', 'budget'))
+    for name, module in console_scripts(args.setup_cfg):
+        if args.scripts and name not in args.scripts:
+            continue
+        budget = BUDGETS.get(name, DEFAULT_BUDGET)
+        try:
+            elapsed = min(import_time(args.python, module)
+                          for i in range(args.runs))
+        except MissingModule as e:
+            # Broken entry points are not an import time problem
+            print("%-26s %10s %10d  %s" % (name, 'missing', budget, e))
+            continue
+        except RuntimeError as e:
+            print("%-26s %10s %10d  %s" % (name, 'error', budget, e))
+            failed = True
+            continue
+        status = ''
+        if elapsed > budget:
+            status = '  OVER BUDGET'
+            failed = True
+        print("%-26s %10.1f %10d%s" % (name, elapsed, budget, status))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()